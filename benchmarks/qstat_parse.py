@@ -0,0 +1,105 @@
+"""Compare the streaming qstat parser with the previous etree_to_dict path.
+
+    PYTHONPATH=. python benchmarks/qstat_parse.py [num_jobs]
+
+Generates synthetic ``qstat -xml`` output with ``num_jobs`` pending array
+tasks and reports time and peak traced memory for both parsers.
+"""
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+
+from psub.utilities.sge_monitor import parse_job_list
+
+
+class LegacyJob:
+    pass
+
+
+def etree_to_dict(t):
+    d = {t.tag: {} if t.attrib else None}
+    children = list(t)
+    if children:
+        dd = defaultdict(list)
+        for dc in map(etree_to_dict, children):
+            for k, v in dc.items():
+                dd[k].append(v)
+        d = {t.tag: {k: v[0] if len(v) == 1 else v for k, v in dd.items()}}
+    if t.attrib:
+        d[t.tag].update(('@' + k, v) for k, v in t.attrib.items())
+    if t.text:
+        text = t.text.strip()
+        if children or t.attrib:
+            if text:
+                d[t.tag]['#text'] = text
+        else:
+            d[t.tag] = text
+    return d
+
+
+def legacy_parse_job_list(xml_):
+    dd = etree_to_dict(ET.XML(xml_))
+    job_list = []
+    for section in ['queue_info', 'job_info']:
+        try:
+            ll = dd['job_info'][section]['job_list']
+        except Exception:
+            ll = []
+        job_list += ll if isinstance(ll, list) else [ll]
+
+    jobs = []
+    for job_d in job_list:
+        j = LegacyJob()
+        j.__dict__.update(job_d)
+        jobs.append(j)
+    return jobs
+
+
+def synthetic_qstat_xml(num_jobs: int) -> bytes:
+    job_l = [
+        f"""    <job_list state="pending">
+      <JB_job_number>{100000 + i // 100}</JB_job_number>
+      <JAT_prio>0.00000</JAT_prio>
+      <JB_name>sweep.2021_05_01T0900.commands.sh_{i // 100}</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>qw</state>
+      <JB_submission_time>2021-05-01T09:00:00</JB_submission_time>
+      <queue_name></queue_name>
+      <jclass_name></jclass_name>
+      <slots>1</slots>
+      <tasks>{i % 100 + 1}</tasks>
+    </job_list>"""
+        for i in range(num_jobs)
+    ]
+    return ("<?xml version='1.0'?>\n<job_info>\n  <queue_info>\n  </queue_info>\n"
+            "  <job_info>\n" + "\n".join(job_l) + "\n  </job_info>\n</job_info>\n").encode()
+
+
+def measure(parse, xml_):
+    start = time.perf_counter()
+    jobs = parse(xml_)
+    elapsed = time.perf_counter() - start
+    del jobs
+
+    # separate run, tracing slows parsing down considerably
+    tracemalloc.start()
+    jobs = parse(xml_)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(jobs), elapsed, peak
+
+
+def main():
+    num_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    xml_ = synthetic_qstat_xml(num_jobs)
+    print(f"{num_jobs} jobs, {len(xml_) / 1e6:.1f} MB of XML")
+
+    for name, parse in [("etree_to_dict", legacy_parse_job_list), ("iterparse", parse_job_list)]:
+        n, elapsed, peak = measure(parse, xml_)
+        print(f"{name:>14}: {n} jobs in {elapsed:.2f} s, peak {peak / 1e6:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Where the commands of a ``Psub`` are run.
+
+``submit`` prepares the commands file and scripts in ``tmp_dir`` and hands the
+job to a backend. ``SgeBackend`` submits the array with ``qsub``;
+``LocalBackend`` runs the same commands file on this machine. Both write the
+exit status ledger and ``job.<line>.<host>.log`` logs, so status checks and
+log viewing do not depend on where a job ran.
+"""
+import abc
+import os
+import re
+import socket
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from psub.commands_file import iter_commands
+from psub.exit_status import (
+    format_record, format_usage_record, LEDGER_PREFIX, USAGE_PREFIX, STARTED, ENDED
+)
+
+# commands handed to each local worker ahead of time, so memory doesn't grow with the job
+LOCAL_QUEUED_PER_WORKER = 4
+
+# "Your job 123 (...) has been submitted" or "Your job-array 123.1-10:1 (...) ..."
+QSUB_JOB_ID_RE = re.compile(r"Your job(?:-array)? (\d+)")
+
+
+class Backend(abc.ABC):
+    name: str = None
+
+    @abc.abstractmethod
+    def submit(self, p) -> str:
+        """Run or queue the prepared job, after the jobs in ``p._after``.
+
+        Backends that get a scheduler job ID add it to ``p.job_ids``.
+
+        :return: Output to show the user
+        """
+
+
+def parse_job_id(qsub_output: str):
+    match = QSUB_JOB_ID_RE.search(qsub_output)
+    return int(match.group(1)) if match else None
+
+
+class SgeBackend(Backend):
+    name = "sge"
+
+    def _submit_shard(self, p, line_offset: int, num_lines: int) -> str:
+        comp_process = subprocess.run(
+            f". {p.submission_script_fn} {p.commands_list_fn} {p.batch_size} {line_offset} {num_lines}",
+            shell=True,
+            executable="/bin/bash",  # dash's "." drops the script arguments
+            universal_newlines=True,
+            stdout=subprocess.PIPE,
+        )
+        return comp_process.stdout
+
+    def submit(self, p) -> str:
+        """One qsub per shard, ``p.submit_workers`` at a time."""
+        shards = p._shards()
+        with ThreadPoolExecutor(max_workers=max(1, p.submit_workers)) as executor:
+            outputs = list(executor.map(lambda shard: self._submit_shard(p, *shard), shards))
+
+        for output in outputs:
+            job_id = parse_job_id(output)
+            if job_id is not None:
+                p.job_ids.append(job_id)
+        return "".join(outputs)
+
+
+def exit_status_from_wait_status(wait_status: int) -> int:
+    """Exit status as bash reports it, 128 + signal for a killed command.
+
+    Decoded by hand since os.waitstatus_to_exitcode needs Python 3.9.
+    """
+    if os.WIFSIGNALED(wait_status):
+        return 128 + os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+
+def run_command(line: int, command: str, exit_status_dir: str, log_dir: str,
+                max_attempts: int = 1) -> int:
+    """Run one command as run_task.sh would, recording it in this host's ledger.
+
+    :return: Exit status of the last attempt
+    """
+    host = socket.gethostname()
+    ledger_fn = f"{exit_status_dir}/{LEDGER_PREFIX}{host}"
+    usage_fn = f"{exit_status_dir}/{USAGE_PREFIX}{host}"
+    log_fn = f"{log_dir}/job.{line}.{host}.log"
+
+    for _ in range(max_attempts):
+        with open(ledger_fn, "ab") as f:
+            f.write(format_record(line, STARTED, int(time.time()), -1, host))
+        start = time.monotonic()
+        with open(log_fn, "w") as log_f:
+            proc = subprocess.Popen(
+                command, shell=True, executable="/bin/bash",
+                stdout=log_f, stderr=subprocess.STDOUT,
+            )
+            # wait4 rather than wait, for this command's own CPU time and peak RSS
+            _, wait_status, rusage = os.wait4(proc.pid, 0)
+        wall = time.monotonic() - start
+        exit_status = exit_status_from_wait_status(wait_status)
+        proc.returncode = exit_status  # already reaped
+        with open(ledger_fn, "ab") as f:
+            f.write(format_record(line, ENDED, int(time.time()), exit_status, host))
+        with open(usage_fn, "ab") as f:
+            f.write(format_usage_record(line, wall, rusage.ru_utime, rusage.ru_stime,
+                                        rusage.ru_maxrss))
+        if exit_status == 0:
+            break
+    return exit_status
+
+
+class LocalBackend(Backend):
+    """Runs every command on this machine, ``max_workers`` at a time.
+
+    ``submit`` returns once all commands have finished.
+    """
+    name = "local"
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or os.cpu_count()
+
+    def submit(self, p) -> str:
+        for other in p._after:
+            other.wait()
+
+        max_workers = self.max_workers
+        if p.max_concurrent is not None:
+            max_workers = max(1, min(max_workers, p.max_concurrent))
+
+        exit_status_dir = f"{p.tmp_dir}/exit_status"
+        num_run = num_failed = 0
+        pending = set()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for line, command in enumerate(iter_commands(p.commands_list_fn), start=1):
+                if len(pending) >= max_workers * LOCAL_QUEUED_PER_WORKER:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    num_failed += sum(future.result() != 0 for future in done)
+                pending.add(executor.submit(run_command, line, command, exit_status_dir,
+                                            p.log_dir, p.max_attempts))
+                num_run += 1
+            num_failed += sum(future.result() != 0 for future in pending)
+
+        return f"Ran {num_run} commands locally on {max_workers} workers, {num_failed} failed"
+
+
+BACKENDS = {backend.name: backend for backend in (SgeBackend, LocalBackend)}
+
+
+def get_backend(backend) -> Backend:
+    """Backend instance from a name or an instance."""
+    if isinstance(backend, Backend):
+        return backend
+    try:
+        return BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {sorted(BACKENDS)}")
@@ -0,0 +1,59 @@
+"""Choosing a batch size and h_rt from how long the same commands took before."""
+import math
+from typing import List, NamedTuple
+
+MIN_COMMAND_SECONDS = 0.1  # ledger timestamps are whole seconds
+H_RT_SAFETY_FACTOR = 1.5
+MIN_H_RT_SECONDS = 10 * 60
+
+
+class BatchChoice(NamedTuple):
+    batch_size: int
+    h_rt_seconds: int
+    reason: str
+
+
+def parse_time(time_str: str) -> int:
+    """h_rt style H:MM:SS to seconds"""
+    seconds = 0
+    for part in time_str.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def format_time(seconds: int) -> str:
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def choose_batch_size(durations: List[int], target_task_seconds: int,
+                      num_workers: int = 1, num_runs: int = 1) -> BatchChoice:
+    """Batch size whose tasks take about ``target_task_seconds``.
+
+    Sizing uses the mean command duration, since that is what a batch adds up
+    to. h_rt leaves room for a batch that runs slow and for the slowest single
+    command seen.
+    """
+    mean = max(sum(durations) / len(durations), MIN_COMMAND_SECONDS)
+    p95 = percentile(durations, 0.95)
+
+    batch_size = max(1, int(target_task_seconds * num_workers / mean))
+    expected_seconds = batch_size * mean / num_workers
+    h_rt_seconds = max(
+        H_RT_SAFETY_FACTOR * max(expected_seconds, max(durations)), MIN_H_RT_SECONDS
+    )
+    h_rt_seconds = int(math.ceil(h_rt_seconds))
+
+    reason = (
+        f"{len(durations)} commands from {num_runs} previous run(s) took "
+        f"{mean:.1f} s on average (95th percentile {p95} s, max {max(durations)} s); "
+        f"{batch_size} per task at {num_workers} worker(s) should take about "
+        f"{format_time(expected_seconds)} against a target of {format_time(target_task_seconds)}, "
+        f"requesting h_rt={format_time(h_rt_seconds)}"
+    )
+    return BatchChoice(batch_size, h_rt_seconds, reason)
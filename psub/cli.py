@@ -1,12 +1,15 @@
 import argparse
+import logging
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from glob import glob
 import shutil
 
 from simple_term_menu import TerminalMenu
 
 from psub import Psub, __version__
+from psub.logs import log_preview, LogSearchIndex, task_id_from_log_fn
 
 
 class AnsiColors:
@@ -23,81 +26,125 @@ class AnsiColors:
     UNDERLINE = "\033[4m"
 
 
-def check_status_workflow():
-    psub_history_recent_first = sorted(
-        Psub.get_history(), key=lambda x: x.submit_time, reverse=True
-    )
-    terminal_menu = _job_select_terminal_menu(psub_history_recent_first, with_status=True)
-    run_choice = terminal_menu.show()
+class StatusFetcher:
+    """Computes job statuses in a thread pool so the menu can be shown right away.
 
-    while run_choice is not None:
-        pp = psub_history_recent_first[run_choice]
-        terminal_menu_logs = _log_select_terminal_menu_with_status(pp)
+    A job whose status is not in yet shows as "...", and the preview waits at
+    most ``timeout`` seconds for it, so one slow $SCRATCH directory does not
+    hold up the others.
+    """
 
-        log_fns = sorted(glob(f"{pp.log_dir}/*"))
-        log_choice = terminal_menu_logs.show()
+    def __init__(self, history_entries, max_workers=16, timeout=5.0):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = [self._executor.submit(self._status, entry) for entry in history_entries]
 
-        while log_choice is not None:
-            if shutil.which('bat'):  # check if bat (cat alternative) is installed
-                _ = subprocess.run(["bat", "--paging=always", "--wrap=never", f"{log_fns[log_choice]}"])
-            else:  # fallback to less
-                _ = subprocess.run(["less", f"{log_fns[log_choice]}"])
-            log_choice = terminal_menu_logs.show()
+    @staticmethod
+    def _status(entry) -> str:
+        try:
+            return entry.load().status
+        except Exception as e:
+            logging.debug(f"Could not get status of {entry.name}: {e}")
+            return "Unavailable"
 
-        run_choice = terminal_menu.show()
+    def get(self, i, wait=False) -> str:
+        try:
+            return self._futures[i].result(timeout=self.timeout if wait else 0)
+        except TimeoutError:
+            return "..."
 
+    def num_done(self) -> int:
+        return sum(f.done() for f in self._futures)
 
-def _job_select_terminal_menu(psub_history_recent_first, with_status=False, num_with_status=10):
-    one_line_reps = [p.str_single_line() for p in psub_history_recent_first]
+    def shutdown(self):
+        for f in self._futures:
+            f.cancel()
+        self._executor.shutdown(wait=False)
 
-    if with_status:
-        statuses = []
-        reps_with_status = []
-        for j, p in enumerate(psub_history_recent_first):
-            if j < num_with_status:
-                status_ = p.status
-                statuses.append(status_)
 
-                rep = one_line_reps[j]
-                reps_with_status.append(f"{rep} -> {status_}")
-            else:
-                statuses.append("...")
-                rep = one_line_reps[j]
-                reps_with_status.append(f"{rep} -> ...")
+def check_status_workflow():
+    psub_history_recent_first = Psub.get_history_index()
+    status_fetcher = StatusFetcher(psub_history_recent_first)
+    try:
+        terminal_menu = _job_select_terminal_menu(psub_history_recent_first, status_fetcher)
+        run_choice = terminal_menu.show()
+
+        while run_choice is not None:
+            pp = psub_history_recent_first[run_choice].load()
+            terminal_menu_logs = _log_select_terminal_menu_with_status(pp)
+
+            log_fns = sorted(glob(f"{pp.log_dir}/*"))
+            log_choice = terminal_menu_logs.show()
+
+            while log_choice is not None:
+                if shutil.which('bat'):  # check if bat (cat alternative) is installed
+                    _ = subprocess.run(["bat", "--paging=always", "--wrap=never", f"{log_fns[log_choice]}"])
+                else:  # fallback to less
+                    _ = subprocess.run(["less", f"{log_fns[log_choice]}"])
+                log_choice = terminal_menu_logs.show()
+
+            # rebuild so that statuses that came in meanwhile show up in the list
+            terminal_menu = _job_select_terminal_menu(
+                psub_history_recent_first, status_fetcher, cursor_index=run_choice
+            )
+            run_choice = terminal_menu.show()
+    finally:
+        status_fetcher.shutdown()
+
+
+STATUS_COLORS = {
+    "Finished": AnsiColors.OKGREEN,
+    "Errors": AnsiColors.FAIL,
+    "Queue error": AnsiColors.FAIL,
+    "Not yet started": AnsiColors.OKBLUE,
+    "Queued": AnsiColors.OKBLUE,
+    "Held": AnsiColors.OKBLUE,
+    "Running": AnsiColors.OKCYAN,
+    "Not started, no longer queued": AnsiColors.WARNING,
+    "Stopped": AnsiColors.WARNING,
+    "Unavailable": AnsiColors.WARNING,
+    "...": AnsiColors.OKBLUE,
+}
+
+
+def _psub_preview_with_status(p: Psub, status_: str) -> str:
+    # statuses added later get the warning colour rather than break the menu
+    color_code = next((col for k, col in STATUS_COLORS.items() if status_.startswith(k)),
+                      AnsiColors.WARNING)
+    status_c = f"{color_code}{status_}{AnsiColors.ENDC}"
+    return f"{status_c} \n" f"{str(p)}"
+
+
+def _job_select_terminal_menu(psub_history_recent_first, status_fetcher=None, cursor_index=None):
+    one_line_reps = [p.str_single_line() for p in psub_history_recent_first]
 
-        one_line_reps_ = reps_with_status
+    if status_fetcher is not None:
+        one_line_reps_ = [
+            f"{rep} -> {status_fetcher.get(j)}" for j, rep in enumerate(one_line_reps)
+        ]
 
         def psub_preview_with_status(i) -> str:
-            p = psub_history_recent_first[int(i)]
-            status_ = statuses[int(i)]
-
-            ansi_color_code_d = {
-                "Finished": AnsiColors.OKGREEN,
-                "Errors": AnsiColors.FAIL,
-                "Not yet started": AnsiColors.OKBLUE,
-                "Running": AnsiColors.OKCYAN,
-                "...": AnsiColors.OKBLUE,
-            }
-
-            color_code = [
-                col for k, col in ansi_color_code_d.items() if status_.startswith(k)
-            ][0]
-
-            status_c = f"{color_code}{status_}{AnsiColors.ENDC}"
-            s_ = f"{status_c} \n" f"{str(p)}"
-            return s_
+            p = psub_history_recent_first[int(i)].load()
+            return _psub_preview_with_status(p, status_fetcher.get(int(i), wait=True))
 
         psub_preview_ = psub_preview_with_status
 
+        def status_bar(_) -> str:
+            return (f"q -> go back, / -> search "
+                    f"[{status_fetcher.num_done()}/{len(psub_history_recent_first)} statuses]")
+
+        status_bar_ = status_bar
+
     else:
         one_line_reps_ = one_line_reps
 
         def psub_preview(i) -> str:
-            p = psub_history_recent_first[int(i)]
+            p = psub_history_recent_first[int(i)].load()
             s_ = f"{str(p)}"
             return s_
 
         psub_preview_ = psub_preview
+        status_bar_ = "q -> go back, / -> search"
 
     one_line_reps_with_data_component = [
         menu_item.replace("|", r"\|") + "|" + str(i)
@@ -109,7 +156,8 @@ def _job_select_terminal_menu(psub_history_recent_first, with_status=False, num_
         title="Psub job history:",
         preview_command=psub_preview_,
         preview_size=0.75,
-        status_bar="q -> go back, / -> search",
+        status_bar=status_bar_,
+        cursor_index=cursor_index,
     )
 
     return terminal_menu
@@ -118,17 +166,6 @@ def _job_select_terminal_menu(psub_history_recent_first, with_status=False, num_
 def _log_select_terminal_menu(pp: Psub):
     log_fns = sorted(glob(f"{pp.log_dir}/*"))
 
-    def log_preview(log_fn) -> str:
-        log_l = []
-        with open(log_fn) as f:
-            for line in f:
-                log_l.append(line)
-        if len(log_l) > 30:
-            log_str = ''.join(log_l[:15] + ['...\n'] + log_l[-15:])
-        else:
-            log_str = ''.join(log_l)
-        return log_str
-
     terminal_menu_logs = TerminalMenu(
         log_fns,
         title=f"Job logs for {pp.name}:",
@@ -146,9 +183,13 @@ def _log_select_terminal_menu_with_status(pp: Psub):
     log_fn_with_exit_code_d = {}
     log_fn_with_exit_code_d_no_error = {}
     log_fn_with_exit_code_d_with_error = {}
+    task_log_fns = []
 
     for log_fn in log_fns:
-        job_number = int(log_fn.split('/')[-1].split('.')[1])
+        job_number = task_id_from_log_fn(log_fn)
+        if job_number is None:  # a whole array task's log, numbered by the scheduler
+            task_log_fns.append(f"{log_fn} ## task log")
+            continue
         exit_code = exit_codes_d.get(int(job_number))
         log_fn_with_exit_code_d[job_number]  = f"{log_fn} ## {exit_code}"
 
@@ -160,24 +201,16 @@ def _log_select_terminal_menu_with_status(pp: Psub):
     l1 = [log_fn_with_exit_code_d_with_error[key] for key in sorted(log_fn_with_exit_code_d_with_error.keys())]
     l2 = [log_fn_with_exit_code_d_no_error[key] for key in sorted(log_fn_with_exit_code_d_no_error.keys())]
     
-    log_fn_with_exit_code_l = l1 + l2
+    log_fn_with_exit_code_l = l1 + l2 + task_log_fns
 
-    def log_preview(log_fn_with_exit_code) -> str:
+    def log_preview_with_exit_code(log_fn_with_exit_code) -> str:
         log_fn, exit_code = log_fn_with_exit_code.split(' ## ')
-        log_l = []
-        with open(log_fn) as f:
-            for line in f:
-                log_l.append(line)
-        if len(log_l) > 30:
-            log_str = ''.join(log_l[:15] + ['...\n'] + log_l[-15:])
-        else:
-            log_str = ''.join(log_l)
-        return log_str
+        return log_preview(log_fn)
 
     terminal_menu_logs = TerminalMenu(
         log_fn_with_exit_code_l,
         title=f"Job logs for {pp.name}:",
-        preview_command=log_preview,
+        preview_command=log_preview_with_exit_code,
         preview_size=0.75,
         status_bar="q -> go back, / -> search",
     )
@@ -186,15 +219,13 @@ def _log_select_terminal_menu_with_status(pp: Psub):
 
 
 def logging_workflow():
-    psub_history_recent_first = sorted(
-        Psub.get_history(), key=lambda x: x.submit_time, reverse=True
-    )
+    psub_history_recent_first = Psub.get_history_index()
 
     terminal_menu = _job_select_terminal_menu(psub_history_recent_first)
     run_choice = terminal_menu.show()
 
     while run_choice is not None:
-        pp = psub_history_recent_first[run_choice]
+        pp = psub_history_recent_first[run_choice].load()
         terminal_menu_logs = _log_select_terminal_menu(pp)
 
         log_fns = sorted(glob(f"{pp.log_dir}/*"))
@@ -210,6 +241,37 @@ def logging_workflow():
         run_choice = terminal_menu.show()
 
 
+def search_logs_workflow(pattern, job_name_filter=None):
+    for entry in Psub.get_history_index():
+        if job_name_filter is not None and job_name_filter not in entry.name:
+            continue
+
+        search_index = LogSearchIndex(entry.log_dir)
+        search_index.update()
+        hits = search_index.search(pattern)
+        if not hits:
+            continue
+
+        exit_codes_d = entry.load()._get_exit_codes()
+        print(f"{AnsiColors.BOLD}{entry.name}{AnsiColors.ENDC}")
+        for log_fn, line_num, line in hits:
+            job_number = task_id_from_log_fn(log_fn)
+            if job_number is None:  # a whole array task's log, no single exit code
+                exit_code, color_code = "task", AnsiColors.OKBLUE
+            else:
+                exit_code = exit_codes_d.get(job_number)
+                color_code = AnsiColors.OKGREEN if exit_code == '0' else AnsiColors.FAIL
+            print(f"  {color_code}[{exit_code}]{AnsiColors.ENDC} {log_fn}:{line_num}: {line}")
+
+
+def _find_history_entry(name_part=None):
+    """Most recent job whose name contains ``name_part``."""
+    for entry in Psub.get_history_index():
+        if name_part is None or name_part in entry.name:
+            return entry
+    return None
+
+
 def main():
     ARGPARSE_HELP_STRING = """
 Submit and monitor jobs, organize logs on UCLA's Hoffman2 cluster.
@@ -227,9 +289,13 @@ Submitting jobs:
     
 Viewing logs:
     Use the `psub logs` subcommand.
+    `psub logs --search PATTERN` prints matching log lines with task exit codes.
     
 Checking job statuses:
     Use the `psub status` subcommand.
+
+Upgrading old history records:
+    Use the `psub migrate-history` subcommand.
 """
 
     ARGPARSE_HELP_STRING = f"psub {__version__}:" + ARGPARSE_HELP_STRING
@@ -252,7 +318,99 @@ Checking job statuses:
     )
 
     parser.add_argument(
-        "-b", "--jobs-per-batch", "--batch-size", help="Number of jobs per batch"
+        "-b", "--jobs-per-batch", "--batch-size",
+        help=(
+            "Number of jobs per batch, or 'auto' to choose it (and --time, unless given) "
+            "from the runtimes of previous runs with the same job name or template."
+        ),
+    )
+
+    parser.add_argument(
+        "--target-task-time",
+        default="0:30:00",
+        help="How long each task should take with --jobs-per-batch auto.",
+    )
+
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help=(
+            "Run the commands of each batch concurrently on the requested cores, "
+            "with one log per command. Use with --jobs-per-batch."
+        ),
+    )
+
+    parser.add_argument(
+        "--queue-workers",
+        type=int,
+        help=(
+            "Run this many array tasks that pull batches from a shared queue until "
+            "it is empty, instead of giving each task a fixed batch."
+        ),
+    )
+
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=1,
+        help="With --queue-workers, run failed commands again up to this many runs in total.",
+    )
+
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Run the commands on this machine, one per CPU at a time, instead of submitting them.",
+    )
+
+    parser.add_argument(
+        "--skip-done",
+        action="store_true",
+        help=(
+            "Leave out commands that already succeeded in an earlier job, "
+            "unless an --input file changed since."
+        ),
+    )
+
+    parser.add_argument(
+        "--input",
+        action="append",
+        dest="input_files",
+        metavar="FILE",
+        help="File the commands read, used by --skip-done. Can be given several times.",
+    )
+
+    parser.add_argument(
+        "--after",
+        metavar="NAME",
+        help=(
+            "Hold the job until the most recent job whose name contains NAME has finished. "
+            "Task i only waits for task i when both have the same tasks."
+        ),
+    )
+
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        help=(
+            "Most tasks per array job; larger jobs are submitted as several arrays "
+            "(default: 75000, SGE's default max_aj_tasks)."
+        ),
+    )
+
+    parser.add_argument(
+        "--submit-workers",
+        type=int,
+        default=1,
+        help="Number of arrays to submit at the same time when the job is split.",
+    )
+
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        help=(
+            "Most tasks to run at the same time (-tc). "
+            "'psub throttle NAME' adjusts it while the job runs."
+        ),
     )
 
     parser.add_argument(
@@ -314,13 +472,68 @@ Checking job statuses:
 
     # check if subcommand is 'logs'
     if sys.argv[1] == "logs":
-        logging_workflow()
+        logs_parser = argparse.ArgumentParser(prog="psub logs")
+        logs_parser.add_argument(
+            "--search", help="Print log lines containing this string, across all jobs."
+        )
+        logs_parser.add_argument(
+            "--job", help="Only search jobs whose name contains this string."
+        )
+        logs_args = logs_parser.parse_args(sys.argv[2:])
+        if logs_args.search is not None:
+            search_logs_workflow(logs_args.search, logs_args.job)
+        else:
+            logging_workflow()
         return
 
     if sys.argv[1] == "status":
         check_status_workflow()
         return
 
+    if sys.argv[1] == "usage":
+        usage_parser = argparse.ArgumentParser(prog="psub usage")
+        usage_parser.add_argument(
+            "job", nargs="?",
+            help="Show the most recent job whose name contains this string, instead of the most recent job.",
+        )
+        usage_args = usage_parser.parse_args(sys.argv[2:])
+        entry = _find_history_entry(usage_args.job)
+        if entry is None:
+            print("No matching job in the history")
+            return
+        print(entry.load().resource_usage_table())
+        return
+
+    if sys.argv[1] == "throttle":
+        throttle_parser = argparse.ArgumentParser(
+            prog="psub throttle",
+            description=(
+                "Lower the -tc limit of a running job when its commands start failing or "
+                "slowing down, and raise it again while they run well."
+            ),
+        )
+        throttle_parser.add_argument(
+            "job", nargs="?",
+            help="Most recent job whose name contains this string, instead of the most recent job.",
+        )
+        throttle_parser.add_argument("--min", type=int, default=1, help="Lowest limit.")
+        throttle_parser.add_argument("--max", type=int, help="Highest limit.")
+        throttle_parser.add_argument(
+            "--interval", type=float, default=60.0, help="Seconds between adjustments."
+        )
+        throttle_args = throttle_parser.parse_args(sys.argv[2:])
+        entry = _find_history_entry(throttle_args.job)
+        if entry is None:
+            print("No matching job in the history")
+            return
+        entry.load().throttle(throttle_args.min, throttle_args.max, throttle_args.interval)
+        return
+
+    if sys.argv[1] == "migrate-history":
+        num_migrated = Psub.migrate_history()
+        print(f"Migrated {num_migrated} history records")
+        return
+
     args = parser.parse_args()
 
     if args.logs:
@@ -335,12 +548,37 @@ Checking job statuses:
         l_mem=args.l_mem,
         l_time=args.l_time,
         l_highp=args.l_highp,
-        num_cores=args.cores,
+        num_cores=int(args.cores) if args.cores is not None else None,
+        batch_size=int(args.jobs_per_batch) if args.jobs_per_batch not in {None, "auto"} else None,
+        pack=args.pack,
+        queue_workers=args.queue_workers,
+        max_attempts=args.max_attempts,
+        backend="local" if args.local else "sge",
+        input_files=args.input_files,
+        shard_size=args.shard_size,
+        submit_workers=args.submit_workers,
+        max_concurrent=args.max_concurrent,
     )
 
-    p.add(Psub.parse_psub_command_string_to_command_list(command_str))
+    p.add(Psub.parse_psub_command_string(command_str))
+
+    if args.skip_done:
+        num_skipped = p.skip_done()
+        print(f"Skipping {num_skipped} commands that already succeeded")
+        if not p.num_commands:
+            return
+
+    if args.jobs_per_batch == "auto":
+        p.choose_batch_size(args.target_task_time, set_time=args.l_time is None)
+
+    after = None
+    if args.after is not None:
+        entry = _find_history_entry(args.after)
+        if entry is None:
+            raise SystemExit(f"No job matching {args.after!r} in the history")
+        after = entry.load()
 
-    p.submit(dry_run=args.dry_run, skip_confirm=args.yes)
+    p.submit(dry_run=args.dry_run, skip_confirm=args.yes, after=after)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+import itertools
+import re
+from typing import Iterator, List, Sequence
+
+from psub.commands_file import iter_commands, read_commands, file_sha256
+
+
+class CommandGrid:
+    """Commands formed by filling a template with every combination of parameters.
+
+    The combinations are generated on demand, in ``itertools.product`` order,
+    so a grid over a few large parameter lists never has to be held in memory
+    as a list of strings.
+    """
+
+    def __init__(self, template: str, parameters: Sequence[Sequence[str]]):
+        num_fields = len(re.findall(r"{}", template))
+        assert num_fields == len(parameters), (
+            f"Mismatch between number of fields in template and number "
+            f"of parameters: {num_fields}, {len(parameters)} "
+        )
+
+        self.template = template
+        self.parameters: List[List[str]] = [list(p) for p in parameters]
+
+    def __len__(self) -> int:
+        num_commands = 1
+        for p in self.parameters:
+            num_commands *= len(p)
+        return num_commands
+
+    def __iter__(self) -> Iterator[str]:
+        template = self.template
+        for c in itertools.product(*self.parameters):
+            yield template.format(*c)
+
+    def __getitem__(self, i: int) -> str:
+        num_commands = len(self)
+        if i < 0:
+            i += num_commands
+        if not 0 <= i < num_commands:
+            raise IndexError("CommandGrid index out of range")
+
+        # the last parameter varies fastest, as in itertools.product
+        c = []
+        for p in reversed(self.parameters):
+            i, j = divmod(i, len(p))
+            c.append(p[j])
+        return self.template.format(*reversed(c))
+
+    def __eq__(self, other):
+        return (isinstance(other, CommandGrid)
+                and self.template == other.template
+                and self.parameters == other.parameters)
+
+    def __repr__(self):
+        return f"CommandGrid({self.template!r}, {len(self)} commands)"
+
+
+class CommandsFileChanged(OSError):
+    """The commands file no longer has the contents a history record was written for."""
+
+
+class CommandsFileRange:
+    """A run of lines in a commands file written by ``write_commands_file``.
+
+    Used by history records so that long explicit command lists are not
+    copied into the JSON; individual commands are read back by index. The
+    file is checked against ``sha256`` on first access, so a file rewritten
+    since then raises ``CommandsFileChanged`` rather than returning other
+    commands.
+    """
+
+    def __init__(self, commands_fn: str, start: int, count: int, sha256: str = None):
+        self.commands_fn = commands_fn
+        self.start = start  # 0-based line offset into the file
+        self.count = count
+        self.sha256 = sha256
+        self._verified = False
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[str]:
+        self._check()
+        yield from iter_commands(self.commands_fn, self.start + 1, self.count)
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("CommandsFileRange index out of range")
+        self._check()
+        return read_commands(self.commands_fn, self.start + i + 1)[0]
+
+    def verify(self) -> bool:
+        return self.sha256 is None or file_sha256(self.commands_fn) == self.sha256
+
+    def _check(self):
+        if self._verified:
+            return
+        if not self.verify():
+            raise CommandsFileChanged(
+                f"{self.commands_fn} changed since the history record was written")
+        self._verified = True
+
+    def __repr__(self):
+        return f"CommandsFileRange({self.commands_fn!r}, {self.start}, {self.count})"
+
+
+def source_to_dict(source: Sequence[str]) -> dict:
+    if isinstance(source, CommandGrid):
+        return {"template": source.template, "parameters": source.parameters}
+    if isinstance(source, CommandsFileRange):
+        return {"commands_file": source.commands_fn, "start": source.start,
+                "count": source.count, "sha256": source.sha256}
+    return {"commands": list(source)}
+
+
+def source_from_dict(d: dict) -> Sequence[str]:
+    if "template" in d:
+        return CommandGrid(d["template"], d["parameters"])
+    if "commands_file" in d:
+        return CommandsFileRange(d["commands_file"], d["start"], d["count"], d.get("sha256"))
+    return list(d["commands"])
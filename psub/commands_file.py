@@ -0,0 +1,127 @@
+"""Reading and writing the commands file that array tasks pull their lines from.
+
+Next to ``{name}.commands.sh`` we write ``{name}.commands.idx``: a flat array of
+uint64 byte offsets (native byte order, the compute nodes read it back with
+``od -t u8``). Entry ``i`` is where line ``i + 1`` starts and the last entry is
+the size of the commands file, so lines ``a..b`` span ``idx[a-1]:idx[b]`` and a
+task can seek straight to its block instead of scanning from the top.
+"""
+import hashlib
+import os
+from array import array
+from typing import Iterable, Iterator, List, Tuple
+
+OFFSET_SIZE = array("Q").itemsize
+WRITE_CHUNK_LINES = 10000
+READ_BLOCK_LINES = 10000
+
+
+def commands_index_fn(commands_fn: str) -> str:
+    base, _ = os.path.splitext(commands_fn)
+    return f"{base}.idx"
+
+
+def write_commands_file(commands: Iterable[str], commands_fn: str) -> Tuple[int, str]:
+    """Write one command per line plus the line-offset index.
+
+    :return: Number of commands written and the sha256 of the commands file
+    """
+    sha256 = hashlib.sha256()
+    offsets = array("Q", [0])
+    position = 0
+    num_commands = 0
+
+    with open(commands_fn, "wb") as f_cmd, \
+            open(commands_index_fn(commands_fn), "wb") as f_idx:
+        chunk: List[bytes] = []
+        for cmd_ in commands:
+            line = f"{cmd_}\n".encode()
+            chunk.append(line)
+            position += len(line)
+            offsets.append(position)
+            num_commands += 1
+
+            if len(chunk) >= WRITE_CHUNK_LINES:
+                block = b"".join(chunk)
+                f_cmd.write(block)
+                sha256.update(block)
+                offsets.tofile(f_idx)
+                chunk = []
+                offsets = array("Q")
+
+        block = b"".join(chunk)
+        f_cmd.write(block)
+        sha256.update(block)
+        offsets.tofile(f_idx)
+
+    return num_commands, sha256.hexdigest()
+
+
+def hash_commands(commands: Iterable[str]) -> str:
+    """sha256 that ``write_commands_file`` would report for ``commands``."""
+    sha256 = hashlib.sha256()
+    for cmd_ in commands:
+        sha256.update(f"{cmd_}\n".encode())
+    return sha256.hexdigest()
+
+
+def file_sha256(fn: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_commands(commands_fn: str, first_line: int, num_lines: int = 1) -> List[str]:
+    """Read ``num_lines`` commands starting at 1-based ``first_line``.
+
+    Uses the offset index when there is one, otherwise falls back to scanning
+    the commands file (jobs submitted before the index existed).
+    """
+    idx_fn = commands_index_fn(commands_fn)
+
+    if not os.path.exists(idx_fn):
+        lines = []
+        with open(commands_fn) as f:
+            for i, line in enumerate(f, start=1):
+                if i >= first_line + num_lines:
+                    break
+                if i >= first_line:
+                    lines.append(line.rstrip("\n"))
+        return lines
+
+    num_in_file = os.path.getsize(idx_fn) // OFFSET_SIZE - 1
+    last_line = min(first_line + num_lines - 1, num_in_file)
+    if first_line < 1 or last_line < first_line:
+        return []
+
+    bounds = array("Q")
+    with open(idx_fn, "rb") as f:
+        f.seek((first_line - 1) * OFFSET_SIZE)
+        bounds.fromfile(f, 1)
+        f.seek(last_line * OFFSET_SIZE)
+        bounds.fromfile(f, 1)
+    start, end = bounds
+
+    with open(commands_fn, "rb") as f:
+        f.seek(start)
+        block = f.read(end - start)
+
+    return block.decode().split("\n")[:-1]
+
+
+def iter_commands(commands_fn: str, first_line: int = 1, num_lines: int = None) -> Iterator[str]:
+    """Commands from 1-based ``first_line`` on, ``READ_BLOCK_LINES`` read at a time.
+
+    :param num_lines: Stop after this many, by default at the end of the file
+    """
+    line = first_line
+    end = None if num_lines is None else first_line + num_lines
+    while end is None or line < end:
+        block_lines = READ_BLOCK_LINES if end is None else min(READ_BLOCK_LINES, end - line)
+        commands = read_commands(commands_fn, line, block_lines)
+        if not commands:
+            return
+        yield from commands
+        line += len(commands)
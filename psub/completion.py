@@ -0,0 +1,96 @@
+"""Content-addressed record of commands that have succeeded.
+
+A command's key is the sha256 of the command and the (path, size, mtime) of
+the input files declared for its job, so editing an input changes the key.
+Every submission writes the key of each line to ``{tmp_dir}/{name}.keys``;
+``CompletionCache.harvest`` adds the keys of lines whose exit status is 0 to
+``{PATH_PSUB}/completed.keys``. Which jobs were harvested, and how many
+successes each had at the time, is kept in ``completed.json`` so that only
+jobs with new successes are read again.
+"""
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+
+KEYS_FN = "completed.keys"
+HARVESTED_FN = "completed.json"
+
+
+def input_signature(input_fns: Iterable[str]) -> str:
+    """Identity of the declared input files, from stat rather than their contents."""
+    parts = []
+    for fn in sorted(input_fns):
+        try:
+            st = os.stat(fn)
+            parts.append(f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}")
+        except FileNotFoundError:
+            parts.append(f"{os.path.abspath(fn)}:missing")
+    return "\n".join(parts)
+
+
+def command_key(command: str, signature: str = "") -> str:
+    return hashlib.sha256(f"{signature}\0{command}".encode()).hexdigest()
+
+
+def write_keys_file(keys: Iterable[str], keys_fn: str):
+    with open(keys_fn, "w") as f:
+        for key in keys:
+            print(key, file=f)
+
+
+def read_keys_file(keys_fn: str) -> Optional[List[str]]:
+    try:
+        with open(keys_fn) as f:
+            return f.read().split()
+    except FileNotFoundError:
+        return None
+
+
+class CompletionCache:
+    def __init__(self, cache_dir: str):
+        self.keys_fn = f"{cache_dir}/{KEYS_FN}"
+        self.harvested_fn = f"{cache_dir}/{HARVESTED_FN}"
+
+        self.keys = set(read_keys_file(self.keys_fn) or [])
+        self.harvested: Dict[str, int] = {}  # job json_fn -> successes harvested
+        try:
+            with open(self.harvested_fn) as f:
+                self.harvested = json.load(f)
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError as e:
+            logging.debug(f"Re-harvesting all jobs, {self.harvested_fn} unreadable: {e}")
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def needs_harvest(self, job_id: str, num_success: int) -> bool:
+        return self.harvested.get(job_id) != num_success
+
+    def harvest(self, job_id: str, num_success: int, keys: List[str],
+                exit_statuses: Dict[int, str]):
+        """Add the keys of a job's successful lines (numbered from 1)."""
+        new_keys = {keys[line - 1] for line, value in exit_statuses.items()
+                    if value == "0" and line <= len(keys)} - self.keys
+        if new_keys:
+            os.makedirs(os.path.dirname(self.keys_fn), exist_ok=True)
+            with open(self.keys_fn, "a") as f:
+                for key in new_keys:
+                    print(key, file=f)
+            self.keys |= new_keys
+        self.harvested[job_id] = num_success
+
+    def save(self):
+        tmp_fn = f"{self.harvested_fn}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.harvested_fn), exist_ok=True)
+            with open(tmp_fn, "w") as f:
+                json.dump(self.harvested, f, separators=(",", ":"))
+            os.replace(tmp_fn, self.harvested_fn)
+        except OSError as e:
+            logging.debug(f"Could not save {self.harvested_fn}: {e}")
@@ -0,0 +1,302 @@
+"""Exit status records written by array tasks.
+
+Each task appends fixed-size text records to a per-host ledger,
+``{tmp_dir}/exit_status/ledger.{host}``, so a whole array produces a handful of
+files that can be read back with a few sequential reads::
+
+    <line:12> <state:1> <timestamp:12> <exit_code:5> <host:29>\\n
+
+``state`` is ``S`` when a command starts and ``E`` when it ends. Jobs submitted
+before the ledger existed wrote one ``exit_status/<line>`` file per command;
+those are still read.
+
+Alongside, ``usage.{host}`` gets one record per finished command with its
+wall time, user and system CPU seconds and peak RSS in KB::
+
+    <line:12> <wall:11> <user:11> <system:11> <max_rss_kb:14>\n
+"""
+import json
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, List, NamedTuple, Tuple
+
+RECORD_SIZE = 64
+LEDGER_PREFIX = "ledger."
+USAGE_PREFIX = "usage."
+STARTED = "S"
+ENDED = "E"
+
+OUTCOME_STARTED = "started"
+OUTCOME_SUCCESS = "success"
+OUTCOME_FAILED = "failed"
+
+CACHE_FN = ".status_cache.json"
+CACHE_VERSION = 1
+# between saves of the caches that watchers and the throttle refresh every poll
+POLLING_SAVE_INTERVAL = 300.0
+
+
+class StatusRecord(NamedTuple):
+    line: int
+    state: str
+    timestamp: int
+    exit_code: int
+    host: str
+
+    @property
+    def value(self) -> str:
+        """Value in the format of the legacy per-line files."""
+        return "started" if self.state == STARTED else str(self.exit_code)
+
+    @property
+    def sort_key(self) -> Tuple[int, int]:
+        return self.timestamp, self.state == ENDED
+
+
+def format_record(line: int, state: str, timestamp: int, exit_code: int, host: str) -> bytes:
+    return f"{line:>12} {state} {timestamp:>12} {exit_code:>5} {host:<29.29}\n".encode()
+
+
+def parse_record(raw: bytes) -> StatusRecord:
+    line, state, timestamp, exit_code, host = raw.decode().split(None, 4)
+    return StatusRecord(int(line), state, int(timestamp), int(exit_code), host.strip())
+
+
+class UsageRecord(NamedTuple):
+    line: int
+    wall: float
+    user_cpu: float
+    system_cpu: float
+    max_rss_kb: int
+
+    @property
+    def cpu(self) -> float:
+        return self.user_cpu + self.system_cpu
+
+
+def format_usage_record(line: int, wall: float, user_cpu: float, system_cpu: float,
+                        max_rss_kb: int) -> bytes:
+    return f"{line:>12} {wall:>11.2f} {user_cpu:>11.2f} {system_cpu:>11.2f} {max_rss_kb:>14}\n".encode()
+
+
+def read_usage(exit_status_dir: str) -> Dict[int, UsageRecord]:
+    """Resource usage of every command that finished, by line number.
+
+    A line that ran more than once keeps the record read last.
+    """
+    usage = {}
+    try:
+        entries = [e for e in os.scandir(exit_status_dir) if e.name.startswith(USAGE_PREFIX)]
+    except FileNotFoundError:
+        return usage
+
+    for entry in entries:
+        with open(entry.path, "rb") as f:
+            data = f.read()
+        for i in range(len(data) // RECORD_SIZE):
+            raw = data[i * RECORD_SIZE:(i + 1) * RECORD_SIZE]
+            try:
+                line, wall, user_cpu, system_cpu, max_rss_kb = raw.split()
+                usage[int(line)] = UsageRecord(int(line), float(wall), float(user_cpu),
+                                               float(system_cpu), int(max_rss_kb))
+            except ValueError:
+                logging.debug(f"Malformed usage record in {entry.path}: {raw!r}")
+    return usage
+
+
+def read_ledger(ledger_fn: str, offset: int = 0) -> Tuple[List[StatusRecord], int]:
+    """Read the complete records appended to a ledger after ``offset``.
+
+    :return: Records and the offset to resume from next time
+    """
+    with open(ledger_fn, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+
+    num_complete = len(data) // RECORD_SIZE  # a writer may be mid-append
+    records = []
+    for i in range(num_complete):
+        raw = data[i * RECORD_SIZE:(i + 1) * RECORD_SIZE]
+        try:
+            records.append(parse_record(raw))
+        except ValueError:
+            logging.debug(f"Malformed exit status record in {ledger_fn}: {raw!r}")
+
+    return records, offset + num_complete * RECORD_SIZE
+
+
+def command_durations(exit_status_dir: str) -> List[int]:
+    """Seconds from start to end of every finished command that has both records.
+
+    Legacy per-line files only keep the end time, so they contribute nothing.
+    """
+    durations = []
+    try:
+        entries = [e for e in os.scandir(exit_status_dir) if e.name.startswith(LEDGER_PREFIX)]
+    except FileNotFoundError:
+        return durations
+
+    for entry in entries:
+        records, _ = read_ledger(entry.path)
+        started = {}
+        for r in records:
+            if r.state == STARTED:
+                started[r.line] = r.timestamp
+            elif r.line in started:
+                durations.append(r.timestamp - started.pop(r.line))
+    return durations
+
+
+def read_legacy_status_file(fn: str) -> StatusRecord:
+    with open(fn) as f:
+        exit_status_ = f.readlines()
+    assert len(exit_status_) == 1
+    exit_status, timestamp = exit_status_[0].split()
+    line = int(os.path.basename(fn))
+    if exit_status == "started":
+        return StatusRecord(line, STARTED, int(timestamp), -1, "")
+    return StatusRecord(line, ENDED, int(timestamp), int(exit_status), "")
+
+
+def outcome(record: StatusRecord) -> str:
+    if record.state == STARTED:
+        return OUTCOME_STARTED
+    return OUTCOME_SUCCESS if record.exit_code == 0 else OUTCOME_FAILED
+
+
+class StatusCache:
+    """Exit statuses of one job, kept up to date incrementally.
+
+    Ledgers are only read past the offset seen last time and legacy per-line
+    files are only re-read when their mtime changes and the line has not ended
+    yet. The state is persisted in ``exit_status/.status_cache.json`` so that
+    separate ``psub status`` calls also pick up where the previous one stopped.
+
+    :param save_interval: Least seconds between saves. Each save writes every
+        line's latest record, so caches refreshed every poll set this.
+    """
+
+    def __init__(self, exit_status_dir: str, persist: bool = True, save_interval: float = 0.0):
+        self.exit_status_dir = exit_status_dir
+        self.cache_fn = f"{exit_status_dir}/{CACHE_FN}" if persist else None
+        self.save_interval = save_interval
+        self._unsaved = False
+        self._saved_at = -float("inf")
+
+        self.latest: Dict[int, StatusRecord] = {}
+        self.ledger_offsets: Dict[str, int] = {}
+        self.legacy_mtimes: Dict[str, float] = {}
+        self.counts: Counter = Counter()
+
+        # when set, records that changed a line's status are also kept in new_records
+        # until pop_new_records, for watchers
+        self.track_new = False
+        self.new_records: List[StatusRecord] = []
+
+        self._loaded = False
+
+    def refresh(self) -> "StatusCache":
+        if not self._loaded:
+            self._load()
+
+        try:
+            entries = list(os.scandir(self.exit_status_dir))
+        except FileNotFoundError:
+            return self
+
+        changed = False
+        for entry in entries:
+            name = entry.name
+            if name.startswith(LEDGER_PREFIX):
+                offset = self.ledger_offsets.get(name, 0)
+                if entry.stat().st_size - offset < RECORD_SIZE:
+                    continue
+                records, self.ledger_offsets[name] = read_ledger(entry.path, offset)
+                for r in records:
+                    changed |= self._update(r)
+
+            elif name.isdigit():
+                prev = self.latest.get(int(name))
+                if prev is not None and prev.state == ENDED:
+                    continue
+                mtime = entry.stat().st_mtime
+                if self.legacy_mtimes.get(name) == mtime:
+                    continue
+                try:
+                    r = read_legacy_status_file(entry.path)
+                except Exception as e:
+                    logging.debug(f'Error retrieving exit status: {entry.path}')
+                    logging.debug(e)
+                    continue
+                self.legacy_mtimes[name] = mtime
+                changed |= self._update(r, force=True)
+
+        self._unsaved |= changed
+        if self._unsaved and time.monotonic() - self._saved_at >= self.save_interval:
+            self._save()
+        return self
+
+    def exit_statuses(self) -> Dict[int, str]:
+        """Line number to ``"started"`` or the exit code, as a string."""
+        return {line: r.value for line, r in self.latest.items()}
+
+    def pop_new_records(self) -> List[StatusRecord]:
+        new_records, self.new_records = self.new_records, []
+        return new_records
+
+    def _update(self, r: StatusRecord, force: bool = False) -> bool:
+        prev = self.latest.get(r.line)
+        if prev is not None:
+            if not force and r.sort_key < prev.sort_key:
+                return False
+            if prev == r:  # legacy file re-read after a touch
+                return False
+            self.counts[outcome(prev)] -= 1
+        self.latest[r.line] = r
+        self.counts[outcome(r)] += 1
+        if self.track_new:
+            self.new_records.append(r)
+        return True
+
+    def _load(self):
+        self._loaded = True
+        if self.cache_fn is None or not os.path.exists(self.cache_fn):
+            return
+        try:
+            with open(self.cache_fn) as f:
+                d = json.load(f)
+            assert d["version"] == CACHE_VERSION
+            self.ledger_offsets = d["ledger_offsets"]
+            self.legacy_mtimes = d["legacy_mtimes"]
+            for r in d["records"]:
+                self._update(StatusRecord(*r))
+        except Exception as e:
+            logging.debug(f"Discarding status cache {self.cache_fn}: {e}")
+            self.latest, self.ledger_offsets, self.legacy_mtimes = {}, {}, {}
+            self.counts = Counter()
+
+    def _save(self):
+        self._unsaved = False
+        self._saved_at = time.monotonic()
+        if self.cache_fn is None:
+            return
+        d = {
+            "version": CACHE_VERSION,
+            "ledger_offsets": self.ledger_offsets,
+            "legacy_mtimes": self.legacy_mtimes,
+            "records": list(self.latest.values()),
+        }
+        tmp_fn = f"{self.cache_fn}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_fn, "w") as f:
+                json.dump(d, f, separators=(",", ":"))
+            os.replace(tmp_fn, self.cache_fn)
+        except OSError as e:
+            logging.debug(f"Could not save status cache {self.cache_fn}: {e}")
+
+
+def read_exit_statuses(exit_status_dir: str) -> Dict[int, str]:
+    """Line number to ``"started"`` or the exit code, as a string."""
+    return StatusCache(exit_status_dir, persist=False).refresh().exit_statuses()
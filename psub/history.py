@@ -0,0 +1,110 @@
+"""Index of submitted jobs.
+
+Every submission appends one JSON line to ``{HISTORY_DIR}/index.jsonl`` with
+just enough to list it (name, submit time, command count, a sample command and
+its paths). Listing the history reads only this file; the full ``Psub`` record
+is loaded from its own JSON file when an entry is actually used.
+"""
+import json
+import logging
+from glob import glob
+from typing import List, Optional
+
+INDEX_FN = "index.jsonl"
+
+
+def format_single_line(name: str, num_commands: int, sample_command: str) -> str:
+    max_line_len = 79
+    single_line_str = f"Psub[{num_commands}]: {name} | {sample_command}"
+    if len(single_line_str) > max_line_len:
+        return single_line_str[:max_line_len - 3] + '...'
+    else:
+        return single_line_str
+
+
+class HistoryEntry:
+    def __init__(self, name: str, submit_time: str, num_commands: int,
+                 sample_command: str, json_fn: str, log_dir: str, tmp_dir: str,
+                 job_ids: Optional[List[int]] = None):
+        self.name = name
+        self.submit_time = submit_time
+        self.num_commands = num_commands
+        self.sample_command = sample_command
+        self.json_fn = json_fn
+        self.log_dir = log_dir
+        self.tmp_dir = tmp_dir
+        self.job_ids = job_ids if job_ids is not None else []  # lines from before IDs were kept lack it
+
+        self._psub = None
+
+    @classmethod
+    def from_psub(cls, p, json_fn: str) -> "HistoryEntry":
+        return cls(
+            name=p.name,
+            submit_time=p.submit_time,
+            num_commands=p.num_commands,
+            sample_command=p._display_command(0),
+            json_fn=json_fn,
+            log_dir=p.log_dir,
+            tmp_dir=p.tmp_dir,
+            job_ids=list(p.job_ids),
+        )
+
+    def to_dict(self) -> dict:
+        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+
+    def str_single_line(self) -> str:
+        return format_single_line(self.name, self.num_commands, self.sample_command)
+
+    def load(self):
+        """Full ``Psub`` for this entry, read on first use."""
+        if self._psub is None:
+            from psub.main import Psub
+            self._psub = Psub.load(self.json_fn)
+        return self._psub
+
+    def __repr__(self):
+        return f"HistoryEntry({self.str_single_line()!r})"
+
+
+def append_to_index(history_dir: str, entry: HistoryEntry):
+    with open(f"{history_dir}/{INDEX_FN}", "a") as f:
+        print(json.dumps(entry.to_dict(), separators=(",", ":")), file=f)
+
+
+def read_index(history_dir: str) -> List[HistoryEntry]:
+    entries_d = {}
+    try:
+        with open(f"{history_dir}/{INDEX_FN}") as f:
+            for line in f:
+                try:
+                    entry = HistoryEntry(**json.loads(line))
+                except (json.JSONDecodeError, TypeError):
+                    logging.debug(f"Skipping malformed history index line: {line!r}")
+                    continue
+                entries_d[entry.json_fn] = entry
+    except FileNotFoundError:
+        pass
+    return list(entries_d.values())
+
+
+def list_json_fns(history_dir: str) -> List[str]:
+    return sorted(glob(f"{history_dir}/*.json"))
+
+
+def existing_entries(entries: List[HistoryEntry], json_fns: List[str]) -> List[HistoryEntry]:
+    """Index entries whose record has not been deleted since it was indexed."""
+    json_fns = set(json_fns)
+    return [entry for entry in entries if entry.json_fn in json_fns]
+
+
+def unindexed_json_fns(history_dir: str, entries: List[HistoryEntry],
+                       json_fns: List[str] = None) -> List[str]:
+    """History records written before the index existed.
+
+    :param json_fns: ``list_json_fns(history_dir)``, if already listed
+    """
+    indexed = {entry.json_fn for entry in entries}
+    json_fns = list_json_fns(history_dir) if json_fns is None else json_fns
+    return [fn for fn in json_fns if fn not in indexed]
+
@@ -0,0 +1,181 @@
+"""Helpers for reading and searching job logs."""
+import functools
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+PREVIEW_LINES = 15
+HEAD_BLOCK_SIZE = 64 * 1024
+TAIL_BLOCK_SIZE = 64 * 1024
+MAX_TAIL_SIZE = 1024 * 1024
+INDEX_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def log_preview(log_fn: str, num_lines: int = PREVIEW_LINES) -> str:
+    """First and last ``num_lines`` lines of a log.
+
+    Only a bounded block from either end of the file is read, so multi-GB
+    logs preview as fast as small ones. Previews are cached on
+    (path, size, mtime) so moving the cursor back to a log is instant.
+    """
+    st = os.stat(log_fn)
+    return _cached_log_preview(log_fn, st.st_size, st.st_mtime_ns, num_lines)
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_log_preview(log_fn: str, size: int, mtime_ns: int, num_lines: int) -> str:
+    with open(log_fn, "rb") as f:
+        if size <= HEAD_BLOCK_SIZE + TAIL_BLOCK_SIZE:
+            log_l = f.read().decode(errors="replace").splitlines(keepends=True)
+            if len(log_l) > 2 * num_lines:
+                log_l = log_l[:num_lines] + ['...\n'] + log_l[-num_lines:]
+            return ''.join(log_l)
+
+        head = f.read(HEAD_BLOCK_SIZE).decode(errors="replace")
+        head_l = head.splitlines(keepends=True)[:num_lines]
+        tail_l = _read_tail_lines(f, size, num_lines)
+
+    return ''.join(head_l + ['...\n'] + tail_l)
+
+
+def _read_tail_lines(f, size: int, num_lines: int):
+    """Read backwards from EOF until ``num_lines`` full lines are in."""
+    data = b""
+    position = size
+    while position > 0 and data.count(b"\n") <= num_lines and len(data) < MAX_TAIL_SIZE:
+        block_size = min(TAIL_BLOCK_SIZE, position)
+        position -= block_size
+        f.seek(position)
+        data = f.read(block_size) + data
+
+    tail_l = data.decode(errors="replace").splitlines(keepends=True)
+    return tail_l[-num_lines:]
+
+
+class LogSearchIndex:
+    """Trigram index over the logs of one job, updated incrementally.
+
+    Every log gets a fixed-size signature with one bit set per (hashed) byte
+    trigram it contains. A search only opens logs whose signature has all the
+    bits of the pattern's trigrams, then scans them for line-level hits. The
+    signatures and how far each log was indexed are kept in
+    ``{log_dir}/.search_index.json``, so an update only reads what was
+    appended since the last one.
+    """
+
+    SIGNATURE_BITS = 4096
+    VERSION = 1
+
+    def __init__(self, log_dir: str):
+        self.log_dir = log_dir
+        self.index_fn = f"{log_dir}/.search_index.json"
+        self.files: Dict[str, Tuple[int, int]] = {}  # log name -> (indexed size, signature)
+        self._load()
+
+    @classmethod
+    def _trigram_bit(cls, trigram: Tuple[int, int, int]) -> int:
+        t = trigram[0] << 16 | trigram[1] << 8 | trigram[2]
+        return ((t * 0x9E3779B1) & 0xFFFFFFFF) % cls.SIGNATURE_BITS
+
+    @classmethod
+    def signature(cls, data: bytes) -> int:
+        sig = 0
+        for trigram in set(zip(data, data[1:], data[2:])):
+            sig |= 1 << cls._trigram_bit(trigram)
+        return sig
+
+    def update(self) -> int:
+        """Index whatever was appended to the logs since the last update.
+
+        :return: Number of logs that changed
+        """
+        try:
+            entries = [e for e in os.scandir(self.log_dir) if not e.name.startswith(".")]
+        except FileNotFoundError:
+            return 0
+
+        num_changed = 0
+        for entry in entries:
+            size = entry.stat().st_size
+            indexed_size, sig = self.files.get(entry.name, (0, 0))
+            if size == indexed_size:
+                continue
+            if size < indexed_size:  # rewritten rather than appended to
+                indexed_size, sig = 0, 0
+
+            # back up two bytes so trigrams across the previous end are included
+            position = max(0, indexed_size - 2)
+            reached = min(indexed_size, size)
+            with open(entry.path, "rb") as f:
+                f.seek(position)
+                while position < size - 2:
+                    data = f.read(min(INDEX_BLOCK_SIZE, size - position))
+                    reached = position + len(data)
+                    if len(data) < 3:  # truncated since the stat, by a rerun's ">"
+                        break
+                    sig |= self.signature(data)
+                    position += len(data) - 2
+                    f.seek(position)
+            # a shorter size than now is on disk makes the next update start over
+            self.files[entry.name] = (reached, sig)
+            num_changed += 1
+
+        if num_changed:
+            self._save()
+        return num_changed
+
+    def search(self, pattern: str) -> List[Tuple[str, int, str]]:
+        """Lines containing ``pattern``, as (log path, line number, line)."""
+        pattern_b = pattern.encode()
+        query_sig = self.signature(pattern_b)
+
+        hits = []
+        for name in sorted(self.files):
+            if self.files[name][1] & query_sig != query_sig:
+                continue
+            log_fn = f"{self.log_dir}/{name}"
+            try:
+                with open(log_fn, "rb") as f:
+                    for line_num, line in enumerate(f, start=1):
+                        if pattern_b in line:
+                            hits.append((log_fn, line_num, line.decode(errors="replace").rstrip("\n")))
+            except FileNotFoundError:
+                continue
+        return hits
+
+    def _load(self):
+        try:
+            with open(self.index_fn) as f:
+                d = json.load(f)
+            assert d["version"] == self.VERSION
+            self.files = {name: (size, int(sig, 16)) for name, (size, sig) in d["files"].items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.debug(f"Rebuilding log search index {self.index_fn}: {e}")
+
+    def _save(self):
+        d = {
+            "version": self.VERSION,
+            "files": {name: [size, f"{sig:x}"] for name, (size, sig) in self.files.items()},
+        }
+        tmp_fn = f"{self.index_fn}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_fn, "w") as f:
+                json.dump(d, f, separators=(",", ":"))
+            os.replace(tmp_fn, self.index_fn)
+        except OSError as e:
+            logging.debug(f"Could not save log search index {self.index_fn}: {e}")
+
+
+def task_id_from_log_fn(log_fn: str) -> Optional[int]:
+    """Line in the commands file of a job.<line>.<host>.log.
+
+    None for the logs of whole array tasks, task.<task id>.<host>.log and
+    task_<line offset>.<task id>.<host>.log, whose IDs are the scheduler's.
+    """
+    basename = os.path.basename(log_fn)
+    if basename.startswith("task"):
+        return None
+    return int(basename.split('.')[1])
@@ -1,17 +1,36 @@
-import itertools
 import os
 import subprocess
-from collections import Counter
+import sys
+import time
 from datetime import datetime
 from glob import glob
 from pathlib import Path
-from typing import List, Union, Tuple, Iterator, Dict
-import re
+from typing import List, Union, Iterator, Dict, Sequence, AsyncIterator, Optional, Tuple
 import json
 import logging
 import copy
 
 from psub import submission_scripts
+from psub.backends import Backend, get_backend
+from psub.commands import (
+    CommandGrid, CommandsFileRange, source_to_dict, source_from_dict
+)
+from psub.commands_file import write_commands_file, hash_commands, file_sha256
+from psub.batching import choose_batch_size, parse_time, format_time, percentile
+from psub.throttle import ConcurrencyController, per_array_limit, qalter_tc
+from psub.watch import (
+    StatusWatcher, TaskEvent, DEFAULT_POLL_INTERVAL, DEFAULT_MAX_INTERVAL, DEFAULT_BACKOFF
+)
+from psub.history import (
+    HistoryEntry, format_single_line, append_to_index, read_index, unindexed_json_fns,
+    list_json_fns, existing_entries
+)
+from psub.completion import (
+    CompletionCache, command_key, input_signature, read_keys_file, write_keys_file
+)
+from psub.exit_status import (
+    StatusCache, OUTCOME_STARTED, OUTCOME_SUCCESS, OUTCOME_FAILED, command_durations, read_usage
+)
 
 logging.basicConfig(level=logging.ERROR,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -20,6 +39,17 @@ PATH_PSUB = f"{Path.home()}/.psub"
 TMP_DIR = f"{os.environ.get('SCRATCH', PATH_PSUB)}/psub_tmp"
 HISTORY_DIR = f"{PATH_PSUB}/history"
 
+HISTORY_FORMAT_VERSION = 2
+INLINE_COMMANDS_MAX = 1000  # longer lists are stored as a reference to the commands file
+MAX_HISTORY_SCANNED = 100  # most recent entries searched for previous runs
+DEFAULT_SHARD_SIZE = 75000  # SGE's default max_aj_tasks
+
+SCHEDULER_RUNNING = "running"
+SCHEDULER_QUEUED = "queued"
+SCHEDULER_HELD = "held"
+SCHEDULER_ERROR = "error"
+SCHEDULER_GONE = "gone"
+
 
 class Psub:
     def __init__(
@@ -31,18 +61,16 @@ class Psub:
             l_highp: bool = True,
             num_cores: int = 1,
             batch_size: int = 1,
+            pack: bool = False,
+            queue_workers: int = None,
+            max_attempts: int = 1,
+            backend: Union[str, Backend] = "sge",
+            input_files: List[str] = None,
+            shard_size: int = DEFAULT_SHARD_SIZE,
+            submit_workers: int = 1,
+            max_concurrent: int = None,
     ):
-        if name is None:
-            name = "job"
-        now_str = datetime.now().strftime("%Y_%m_%dT%H%M")
-        self.name = f"{name}.{now_str}"
-
-        self.log_dir = f"{PATH_PSUB}/logs/{self.name}"
-        self.tmp_dir = f"{TMP_DIR}/{self.name}"
-
-        self.commands_list_fn = f"{self.tmp_dir}/{self.name}.commands.sh"
-        self.submission_script_fn = f"{self.tmp_dir}/submission_script.sh"
-        self.task_runner_fn = f"{self.tmp_dir}/run_task.sh"
+        self._set_name(name if name is not None else "job")
 
         self.l_arch = l_arch if l_arch is not None else "intel*"
         self.l_mem = l_mem if l_mem is not None else "4G"
@@ -51,29 +79,97 @@ class Psub:
         self.num_cores = num_cores if num_cores is not None else 1
 
         self.batch_size = batch_size if batch_size is not None else 1
+        # run each task's batch on num_cores concurrent workers instead of serially
+        self.pack = pack if pack is not None else False
+        self.batch_size_reason = None  # set when the batch size is chosen automatically
+        # when set, this many array tasks pull batches from a shared queue until it is empty
+        self.queue_workers = queue_workers
+        # runs per command in queue mode, failed commands are re-enqueued until reached
+        self.max_attempts = max_attempts if max_attempts is not None else 1
+
+        # "sge" submits with qsub, "local" runs the commands on this machine
+        self._backend = get_backend(backend if backend is not None else "sge")
+        self.backend = self._backend.name
+
+        # arrays with more tasks than this are submitted as several arrays, submit_workers at a time
+        self.shard_size = shard_size if shard_size is not None else DEFAULT_SHARD_SIZE
+        self.submit_workers = submit_workers if submit_workers is not None else 1
+
+        # most tasks running at once (-tc), over all shards
+        self.max_concurrent = max_concurrent
+
+        # files the commands read, a command counts as done only while these are unchanged
+        self.input_files = list(input_files) if input_files is not None else []
 
         self.submit_time = None
+        self.job_ids: List[int] = []  # scheduler job IDs, once submitted
+        self.queued_time = None  # epoch seconds at which the scheduler had the job
+        # jobs this one waits for, and whether task i only waits for task i of each
+        self.hold_job_ids: List[int] = []
+        self.hold_per_task = False
+        self._after: List["Psub"] = []
 
-        self.commands: List[str] = []
+        # lists of explicit commands and lazily expanded CommandGrids
+        self._command_sources: List[Sequence[str]] = []
+        self.commands_sha256 = None  # of the commands file, once written
+
+        self._status_cache = None
+
+    def _set_name(self, name: str):
+        now_str = datetime.now().strftime("%Y_%m_%dT%H%M")
+        self.name = f"{name}.{now_str}"
+
+        self.log_dir = f"{PATH_PSUB}/logs/{self.name}"
+        self.tmp_dir = f"{TMP_DIR}/{self.name}"
+
+        self.commands_list_fn = f"{self.tmp_dir}/{self.name}.commands.sh"
+        self.command_keys_fn = f"{self.tmp_dir}/{self.name}.keys"
+        self.submission_script_fn = f"{self.tmp_dir}/submission_script.sh"
+        self.task_runner_fn = f"{self.tmp_dir}/run_task.sh"
+        self.time_command_fn = f"{self.tmp_dir}/time_command.py"
+        self.queue_worker_fn = f"{self.tmp_dir}/run_queue_worker.sh"
+        self.queue_dir = f"{self.tmp_dir}/queue"
 
     def __str__(self):
         repr_str = [
             f"Psub: {self.name}",
             f"Resources to request: {self._build_resource_string()}",
             f"Cores per job: {self.num_cores}",
+        ]
+        if self.backend != "sge":
+            repr_str.append(f"Backend: {self.backend}")
+        repr_str += [
             "",
-            f"{len(self.commands)} commands will be submitted:",
+            f"{self.num_commands} commands will be submitted:",
         ]
 
         if self.batch_size > 1:
             repr_str.append(f"Jobs per batch: {self.batch_size}")
-
-        if len(self.commands) > 10:
-            commands_to_display = self.commands[:5]
+            if self.pack:
+                repr_str.append(f"Each batch runs on {self.num_workers} concurrent workers")
+        if self.batch_size_reason is not None:
+            repr_str.append(f"Batch size: {self.batch_size_reason}")
+        if self.queue_workers:
+            repr_str.append(f"Batches are pulled from a queue by {self.queue_workers} workers")
+            if self.max_attempts > 1:
+                repr_str.append(f"Failed commands are retried, up to {self.max_attempts} runs each")
+        num_shards = len(self._shards())
+        if num_shards > 1:
+            repr_str.append(f"Submitted as {num_shards} arrays of up to {self.shard_size} tasks")
+        if self.max_concurrent is not None:
+            repr_str.append(f"At most {self.max_concurrent} tasks run at once")
+        if self.hold_job_ids:
+            held_for = "the same task of" if self.hold_per_task else "all of"
+            repr_str.append(f"Tasks wait for {held_for} job(s) "
+                            f"{', '.join(str(job_id) for job_id in self.hold_job_ids)}")
+
+        num_commands = self.num_commands
+        if num_commands > 10:
+            commands_to_display = [self._display_command(i) for i in range(5)]
             commands_to_display += ["..."]
-            commands_to_display += self.commands[-5:]
+            commands_to_display += [self._display_command(i) for i in range(num_commands - 5, num_commands)]
         else:
-            commands_to_display = self.commands
+            commands_to_display = [self._display_command(i) for i in range(num_commands)]
 
         for cmd in commands_to_display:
             repr_str.append(cmd)
@@ -84,39 +180,132 @@ class Psub:
         return str(self)
 
     def str_single_line(self):
-        max_line_len = 79
-        sample_command = self.commands[0]
-        single_line_str = f"Psub[{len(self.commands)}]: {self.name} | {sample_command}"
-        if len(single_line_str) > max_line_len:
-            return single_line_str[:max_line_len - 3] + '...'
-        else:
-            return single_line_str
+        return format_single_line(self.name, self.num_commands, self._display_command(0))
 
-    def add(self, commands: Union[List[str], str]):
+    @property
+    def base_name(self) -> str:
+        """Name the job was created with, without the timestamp"""
+        return self.name.rsplit(".", 1)[0]
+
+    def _templates(self) -> set:
+        return {s.template for s in self._command_sources if isinstance(s, CommandGrid)}
+
+    def choose_batch_size(self, target_task_duration: str = "0:30:00", set_time: bool = True,
+                          max_runs: int = 5) -> bool:
+        """Set batch_size (and h_rt) so that tasks take about ``target_task_duration``.
+
+        Command durations come from the exit status records of the most recent
+        runs with the same job name or command template.
+
+        :return: Whether any timing data was found
+        """
+        templates = self._templates()
+        durations = []
+        num_runs = 0
+        for entry in Psub.get_history_index()[:MAX_HISTORY_SCANNED]:
+            if num_runs >= max_runs:
+                break
+            if entry.name.rsplit(".", 1)[0] != self.base_name:
+                if not templates:
+                    continue
+                try:
+                    if not templates & entry.load()._templates():
+                        continue
+                except Exception as e:
+                    logging.debug(f"Could not load {entry.json_fn}: {e}")
+                    continue
+
+            run_durations = command_durations(f"{entry.tmp_dir}/exit_status")
+            if run_durations:
+                durations += run_durations
+                num_runs += 1
+
+        if not durations:
+            self.batch_size_reason = (
+                f"no timing data from previous runs of {self.base_name}, "
+                f"keeping {self.batch_size}"
+            )
+            return False
+
+        choice = choose_batch_size(
+            durations, parse_time(target_task_duration), self.num_workers, num_runs
+        )
+        self.batch_size = choice.batch_size
+        if set_time:
+            self.l_time = format_time(choice.h_rt_seconds)
+        self.batch_size_reason = choice.reason
+        return True
+
+    @property
+    def num_workers(self) -> int:
+        return int(self.num_cores) if self.pack else 1
+
+    @property
+    def commands(self) -> List[str]:
+        return list(self.iter_commands())
+
+    @commands.setter
+    def commands(self, commands: List[str]):
+        self._command_sources = [list(commands)]
+        self.commands_sha256 = None
+
+    @property
+    def num_commands(self) -> int:
+        return sum(len(source) for source in self._command_sources)
+
+    def iter_commands(self) -> Iterator[str]:
+        for source in self._command_sources:
+            yield from source
+
+    def _command_at(self, i: int) -> str:
+        for source in self._command_sources:
+            if i < len(source):
+                return source[i]
+            i -= len(source)
+        raise IndexError("Command index out of range")
+
+    def _display_command(self, i: int) -> str:
+        try:
+            return self._command_at(i)
+        except OSError:  # history record points at a commands file that was cleaned up
+            return f"<{self.commands_list_fn} unavailable>"
+
+    def add(self, commands: Union[List[str], str, CommandGrid]):
         if isinstance(commands, str):
             commands = [commands]
-        self.commands += commands
+        self.commands_sha256 = None
+        if isinstance(commands, CommandGrid):
+            self._command_sources.append(commands)
+        elif self._command_sources and isinstance(self._command_sources[-1], list):
+            self._command_sources[-1] += commands
+        else:
+            self._command_sources.append(list(commands))
 
     def add_parameter_combinations(self, command_template: str,
                                    *parameters: List[str]):
+        self.add(CommandGrid(command_template, parameters))
 
-        num_fields = len(re.findall(r"{}", command_template))
-        assert num_fields == len(parameters), (
-            f"Mismatch between number of fields in template and number "
-            f"of parameters: {num_fields}, {len(parameters)} "
-        )
-
-        parameter_combinations: Iterator[Tuple] = itertools.product(*parameters)
-        self.commands += [command_template.format(*c) for c in parameter_combinations]
-
-    def submit(self, dry_run: bool = False, skip_confirm: bool = False):
-        assert self.commands, "Command list empty"
+    def submit(self, dry_run: bool = False, skip_confirm: bool = False,
+               after: Union["Psub", List["Psub"]] = None, per_task: bool = None):
+        """
+        :param after: Jobs to hold this one until they have finished
+        :param per_task: Let task i start as soon as task i of every ``after``
+            job has finished (-hold_jid_ad) rather than waiting for the whole
+            arrays (-hold_jid). By default it does when the task layouts match.
+        """
+        assert self.num_commands, "Command list empty"
+        if self.max_concurrent is not None and self.backend == "sge":
+            per_array_limit(self.max_concurrent, len(self._shards()))  # raises if too many shards
 
         self.submit_time = datetime.now().isoformat(timespec="seconds")
-
-        subprocess_cmd = (
-            f". {self.submission_script_fn} {self.commands_list_fn} {self.batch_size}"
-        )
+        # a resubmitted object or a copy (rerun_failed) must not carry over the earlier job
+        self.job_ids = []
+        self.queued_time = None
+        self.hold_job_ids = []
+        self.hold_per_task = False
+        self._after = []
+        if after is not None:
+            self._set_after([after] if isinstance(after, Psub) else list(after), per_task)
 
         print(str(self))
 
@@ -131,31 +320,111 @@ class Psub:
 
         if response in {"", "y", "Y"}:
             self._prepare_submit_files()
-            comp_process = subprocess.run(
-                subprocess_cmd,
-                shell=True,
-                universal_newlines=True,
-                stdout=subprocess.PIPE,
-            )
-            print(comp_process.stdout)
+            print(self._get_backend().submit(self))
+            self.queued_time = time.time()
             self._register_to_history()
 
+    def _shards(self) -> List[Tuple[int, int]]:
+        """(line offset, number of lines) of each array job to submit."""
+        num_commands = self.num_commands
+        if self.queue_workers:
+            return [(0, num_commands)]
+        shard_lines = self.shard_size * self.batch_size
+        return [(offset, min(shard_lines, num_commands - offset))
+                for offset in range(0, num_commands, shard_lines)]
+
+    def _same_task_layout(self, other: "Psub") -> bool:
+        return (not self.queue_workers and not other.queue_workers
+                and self.num_commands == other.num_commands
+                and self.batch_size == other.batch_size
+                and len(self._shards()) == len(other._shards()) == 1)
+
+    def _set_after(self, after: List["Psub"], per_task: bool = None):
+        # jobs that already finished have nothing left to hold for
+        self._after = [other for other in after if not other.success]
+        self.hold_job_ids = []
+        for other in self._after:
+            if not other.job_ids and self.backend == "sge":
+                raise ValueError(f"{other.name} has no scheduler job ID to hold for")
+            self.hold_job_ids += other.job_ids
+
+        layouts_match = all(self._same_task_layout(other) for other in self._after)
+        if per_task and not layouts_match:
+            raise ValueError("Per-task holds need the same number of commands and batch size, "
+                             "without queue workers")
+        self.hold_per_task = layouts_match if per_task is None else per_task
+
+    def _scheduler_options(self) -> str:
+        options = []
+        if self.hold_job_ids:
+            option = "-hold_jid_ad" if self.hold_per_task else "-hold_jid"
+            options.append(f"#$ {option} {','.join(str(job_id) for job_id in self.hold_job_ids)}")
+        if self.max_concurrent is not None:
+            # shards run side by side, so they share the limit
+            options.append(f"#$ -tc {per_array_limit(self.max_concurrent, len(self._shards()))}")
+        return "\n".join(options)
+
+    def set_max_concurrent(self, max_concurrent: int):
+        """Change the -tc limit of the submitted job with qalter."""
+        if self.job_ids:
+            # shards that have finished no longer take a share of the limit
+            job_list = self._scheduler_jobs(ttl=0)
+            live_job_ids = (self.job_ids if job_list is None
+                            else sorted({job.JB_job_number for job in job_list}))
+            if live_job_ids:
+                qalter_tc(live_job_ids, max_concurrent)
+        self.max_concurrent = max_concurrent
+
+    def throttle(self, min_concurrent: int = 1, max_concurrent: int = None,
+                 interval: float = 60.0, verbose: bool = True, **controller_kwargs):
+        """Keep adjusting the -tc limit while the job runs, see ConcurrencyController.
+
+        Blocks until every command has ended or the job has left the queue.
+        """
+        controller = ConcurrencyController(self, min_concurrent, max_concurrent,
+                                           **controller_kwargs)
+        controller.run(interval, verbose)
+
+    def _get_backend(self) -> Backend:
+        # records loaded from history only keep the backend's name
+        if self._backend.name != self.backend:
+            self._backend = get_backend(self.backend)
+        return self._backend
+
     def _prepare_submit_files(self):
         os.makedirs(self.log_dir, exist_ok=True)
         os.makedirs(HISTORY_DIR, exist_ok=True)
         os.makedirs(self.tmp_dir, exist_ok=True)
         os.makedirs(f"{self.tmp_dir}/exit_status", exist_ok=True)
 
-        with open(self.commands_list_fn, "w") as f:
-            for cmd_ in self.commands:
-                print(cmd_, file=f)
+        num_commands, self.commands_sha256 = write_commands_file(
+            self.iter_commands(), self.commands_list_fn
+        )
+        if self.queue_workers:
+            self._prepare_queue(num_commands)
+        write_keys_file(self._command_keys(), self.command_keys_fn)
 
+        sharded = len(self._shards()) > 1
         psub_main_params = {
             "l_str": self._build_resource_string(),
             "num_cores": self.num_cores,
+            "num_workers": self.num_workers,
             "logdir": self.log_dir,
             "tmpdir": self.tmp_dir,
-            "pre_task_runner_script": "",
+            # packed tasks, queue workers and shards write one log per command, keep the task log apart
+            "sge_log_prefix": ("task_${LINE_OFFSET}" if sharded
+                               else "task" if self.num_workers > 1 or self.queue_workers
+                               else "job"),
+            "task_range": (f"1-{self.queue_workers}" if self.queue_workers
+                           else "1-${N_TASKS}:${NUM_IN_BATCH}"),
+            "task_runner": os.path.basename(
+                self.queue_worker_fn if self.queue_workers else self.task_runner_fn
+            ),
+            "max_attempts": self.max_attempts,
+            "scheduler_options": self._scheduler_options(),
+            # fixed, so that the scheduler's jobs can be told apart by name too
+            "job_name": os.path.basename(self.commands_list_fn),
+            "pre_task_runner_script": "export PSUB_LINE_LOGS=1" if sharded else "",
             "post_task_runner_script": "",
         }
 
@@ -165,25 +434,41 @@ class Psub:
         with open(self.task_runner_fn, "w") as f:
             print(submission_scripts.RUN_TASK, file=f)
 
+        with open(self.time_command_fn, "w") as f:
+            print(f"#!{sys.executable}{submission_scripts.TIME_COMMAND}", file=f)
+        os.chmod(self.time_command_fn, 0o755)
+
+        if self.queue_workers:
+            with open(self.queue_worker_fn, "w") as f:
+                print(submission_scripts.RUN_QUEUE_WORKER, file=f)
+            os.chmod(self.queue_worker_fn, 0o755)
+
         # make the scripts executable
         os.chmod(self.submission_script_fn, 0o755)
         os.chmod(self.task_runner_fn, 0o755)
 
+    def _prepare_queue(self, num_commands: int):
+        """A cursor file, "<next line> <number of lines>", and empty pending/ and claimed/.
+
+        Workers take the next batch by advancing the cursor under flock, so
+        claiming stays O(1) however many batches there are. Commands to rerun
+        are queued as <line>.1.<attempt> token files in pending/, claimed by
+        renaming them into claimed/, which only one worker can do.
+        """
+        os.makedirs(f"{self.queue_dir}/pending", exist_ok=True)
+        os.makedirs(f"{self.queue_dir}/claimed", exist_ok=True)
+        with open(f"{self.queue_dir}/cursor", "w") as f:
+            print(f"1 {num_commands}", file=f)
+
+    def _exit_status_cache(self) -> StatusCache:
+        exit_status_dir = f"{self.tmp_dir}/exit_status"
+        # history entries are loaded into a fresh Psub, so check the directory
+        if self._status_cache is None or self._status_cache.exit_status_dir != exit_status_dir:
+            self._status_cache = StatusCache(exit_status_dir)
+        return self._status_cache.refresh()
+
     def _get_exit_codes(self):
-        exit_status_fns = sorted(glob(f"{self.tmp_dir}/exit_status/*"))
-        exit_status_d = {}
-        for fn in exit_status_fns:
-            try:
-                task_line_number = int(fn.split('/')[-1])
-                with open(fn) as f:
-                    exit_status_ = f.readlines()
-                    assert len(exit_status_) == 1
-                    exit_status, timestamp = exit_status_[0].split()
-                    exit_status_d[task_line_number] = exit_status
-            except Exception as e:
-                logging.debug(f'Error retrieving exit status: {fn}')
-                logging.debug(e)
-        return exit_status_d
+        return self._exit_status_cache().exit_statuses()
 
     @property
     def exit_codes(self) -> Dict[str, Union[int, str]]:
@@ -211,39 +496,232 @@ class Psub:
         exit_status_d = self._get_exit_codes()
         exit_d = {c: exit_status_d.get(i + 1, "not_yet_started")
                   # line numbers start at 1
-                  for i, c in enumerate(self.commands)}
+                  for i, c in enumerate(self.iter_commands())}
 
         return {c: interpret_code(v) for c, v in exit_d.items()}
 
     @property
     def success(self) -> bool:
-        return all(v == 'Success' for v in self.exit_codes.values())
+        counts = self._exit_status_cache().counts
+        return counts[OUTCOME_SUCCESS] == self.num_commands
 
     @property
-    def status(self) -> str:  # TODO this seems to take a long time
-        exit_vals = self.exit_codes.values()
-        c = Counter(exit_vals)
-        success_rate = c['Success'] / len(exit_vals)
-        error_rate = c['Terminated with nonzero status'] / len(exit_vals)
-        if all(v == 'Success' for v in exit_vals):
+    def status(self) -> str:
+        return self.get_status()
+
+    def get_status(self, job_list: list = None) -> str:
+        """:param job_list: qstat's jobs to look this job up in, instead of the shared snapshot"""
+        counts = self._exit_status_cache().counts
+        num_commands = self.num_commands
+        if counts[OUTCOME_SUCCESS] == num_commands:
             return 'Finished'
-        elif 'Terminated with nonzero status' in exit_vals:
-            return f"Errors [{error_rate:.0%}]"
-        elif all(v == 'Not yet started' for v in exit_vals):
-            return "Not yet started"
+        elif counts[OUTCOME_FAILED]:
+            return f"Errors [{counts[OUTCOME_FAILED] / num_commands:.0%}]"
+
+        scheduler_state = self.scheduler_state(job_list=job_list)
+        if not counts[OUTCOME_STARTED] and not counts[OUTCOME_SUCCESS]:
+            return {
+                SCHEDULER_QUEUED: "Queued",
+                SCHEDULER_HELD: "Held",
+                SCHEDULER_ERROR: "Queue error",
+                SCHEDULER_GONE: "Not started, no longer queued",
+            }.get(scheduler_state, "Not yet started")
+        elif scheduler_state == SCHEDULER_GONE:
+            return f"Stopped [{counts[OUTCOME_SUCCESS] / num_commands:.0%}]"
         else:
-            return f"Running [{success_rate:.0%}]"
+            return f"Running [{counts[OUTCOME_SUCCESS] / num_commands:.0%}]"
+
+    def scheduler_state(self, ttl: float = None, job_list: list = None) -> Optional[str]:
+        """What the scheduler says about this job's tasks, from the shared qstat
+        snapshot or the ``job_list`` a caller already has.
+
+        :return: SCHEDULER_RUNNING if any task is running, else SCHEDULER_QUEUED,
+            SCHEDULER_HELD or SCHEDULER_ERROR for the tasks still waiting, or
+            SCHEDULER_GONE when qstat no longer lists the job. None when the job
+            has no job IDs or qstat can't be read.
+        """
+        jobs = self._scheduler_jobs(ttl, job_list)
+        if jobs is None:
+            return None
+
+        states = [job.state or "" for job in jobs]
+        if not states:
+            return SCHEDULER_GONE
+        if any("r" in state or "t" in state for state in states):
+            return SCHEDULER_RUNNING
+        if any("E" in state for state in states):
+            return SCHEDULER_ERROR
+        if any("h" in state for state in states):
+            return SCHEDULER_HELD
+        return SCHEDULER_QUEUED
+
+    def _scheduler_jobs(self, ttl: float = None, job_list: list = None) -> Optional[list]:
+        """qstat's entries for this job's IDs, None without job IDs or qstat.
+
+        :param job_list: Jobs already read from qstat, rather than the shared snapshot
+        """
+        if not self.job_ids:
+            return None
+        if job_list is None:
+            # imported here, sge_monitor itself uses Psub
+            from psub.utilities.qstat_snapshot import DEFAULT_TTL
+            from psub.utilities.sge_monitor import get_job_list_direct
+
+            try:
+                # a snapshot older than the submission can't list the job yet
+                job_list = get_job_list_direct(DEFAULT_TTL if ttl is None else ttl,
+                                               self.queued_time)
+            except (subprocess.CalledProcessError, OSError) as e:
+                logging.debug(f"Could not read the job list from qstat: {e}")
+                return None
+        return [job for job in job_list if job.JB_job_number in self.job_ids]
+
+    def _all_ended(self, counts) -> bool:
+        """Whether every command has ended, with no queue worker rerun still to come.
+
+        :param counts: Outcome counts from this job's StatusCache
+        """
+        if counts[OUTCOME_SUCCESS] + counts[OUTCOME_FAILED] < self.num_commands:
+            return False
+        if self.queue_workers:
+            for sub_dir in ("pending", "claimed"):
+                try:
+                    if os.listdir(f"{self.queue_dir}/{sub_dir}"):
+                        return False
+                except FileNotFoundError:
+                    pass
+        return True
+
+    def _left_queue(self) -> bool:
+        """Whether the scheduler no longer lists the job, so nothing more will end."""
+        return self.scheduler_state() == SCHEDULER_GONE
+
+    def watch(self, include_finished: bool = True, timeout: float = None,
+              poll_interval: float = DEFAULT_POLL_INTERVAL,
+              max_interval: float = DEFAULT_MAX_INTERVAL,
+              backoff: float = DEFAULT_BACKOFF) -> Iterator[TaskEvent]:
+        """Yield a TaskEvent each time a command ends, until all of them have
+        or the scheduler no longer lists the job.
+
+        Waits on inotify where available and otherwise polls, starting every
+        ``poll_interval`` seconds and backing off by ``backoff`` up to
+        ``max_interval`` while nothing changes.
+
+        :param include_finished: Start with the commands that had already ended
+        :param timeout: Raise TimeoutError after this many seconds
+        """
+        return iter(StatusWatcher(self, include_finished, timeout, poll_interval,
+                                  max_interval, backoff))
+
+    def awatch(self, include_finished: bool = True, timeout: float = None,
+               poll_interval: float = DEFAULT_POLL_INTERVAL,
+               max_interval: float = DEFAULT_MAX_INTERVAL,
+               backoff: float = DEFAULT_BACKOFF) -> AsyncIterator[TaskEvent]:
+        """``watch`` as an async iterator."""
+        return StatusWatcher(self, include_finished, timeout, poll_interval,
+                             max_interval, backoff).__aiter__()
+
+    def wait(self, timeout: float = None, **watch_kwargs) -> bool:
+        """Block until every command has ended, or the job has left the queue without them.
+
+        :return: Whether all of them succeeded
+        """
+        for _ in self.watch(include_finished=False, timeout=timeout, **watch_kwargs):
+            pass
+        return self.success
+
+    async def wait_async(self, timeout: float = None, **watch_kwargs) -> bool:
+        async for _ in self.awatch(include_finished=False, timeout=timeout, **watch_kwargs):
+            pass
+        return self.success
+
+    def resource_usage(self) -> Dict[str, Dict[str, float]]:
+        """Percentiles of the resources used by the finished commands.
+
+        :return: For each of wall_seconds, cpu_seconds, cpu_efficiency and
+            max_rss_mb, the p50, p90, p99 and max
+        """
+        return self._summarize_usage(list(read_usage(f"{self.tmp_dir}/exit_status").values()))
+
+    @staticmethod
+    def _summarize_usage(usage) -> Dict[str, Dict[str, float]]:
+        if not usage:
+            return {}
+
+        values = {
+            "wall_seconds": [u.wall for u in usage],
+            "cpu_seconds": [u.cpu for u in usage],
+            # cores kept busy on average, compare with num_cores
+            "cpu_efficiency": [u.cpu / u.wall for u in usage if u.wall > 0] or [0.0],
+            "max_rss_mb": [u.max_rss_kb / 1024 for u in usage],
+        }
+        return {
+            name: {"p50": percentile(v, 0.5), "p90": percentile(v, 0.9),
+                   "p99": percentile(v, 0.99), "max": max(v)}
+            for name, v in values.items()
+        }
+
+    def resource_usage_table(self) -> str:
+        usage = list(read_usage(f"{self.tmp_dir}/exit_status").values())
+        if not usage:
+            return f"No resource usage recorded yet for {self.name}"
+
+        lines = [
+            f"Resource usage of {len(usage)} commands "
+            f"(requested h_rt={self.l_time}, h_data={self.l_mem}, cores={self.num_cores})",
+            f"{'':<16}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}",
+        ]
+        for name, percentiles in self._summarize_usage(usage).items():
+            lines.append(f"{name:<16}" + "".join(f"{v:>10.2f}" for v in percentiles.values()))
+        return "\n".join(lines)
 
     def rerun_failed(self, dry_run=False, skip_confirm=True):
-        commands_l = [k for k, v in self.exit_codes.items() if v != 'Success']
+        exit_status_d = self._get_exit_codes()
+        commands_l = [c for i, c in enumerate(self.iter_commands(), start=1)
+                      if exit_status_d.get(i) != "0"]
         p = self.copy()
+        # a fresh name, so the new run has its own commands file, exit statuses and logs
+        p._set_name(f"{self.base_name}_rerun")
         p.commands = commands_l
         p.submit(dry_run=dry_run, skip_confirm=skip_confirm)
 
+    def _command_keys(self) -> Iterator[str]:
+        signature = input_signature(self.input_files)
+        return (command_key(c, signature) for c in self.iter_commands())
+
+    def skip_done(self) -> int:
+        """Drop the commands that succeeded in an earlier run with unchanged input files.
+
+        :return: Number of commands dropped
+        """
+        cache = CompletionCache(PATH_PSUB)
+        for entry in Psub.get_history_index():
+            status_cache = StatusCache(f"{entry.tmp_dir}/exit_status").refresh()
+            num_success = status_cache.counts[OUTCOME_SUCCESS]
+            if not cache.needs_harvest(entry.json_fn, num_success):
+                continue
+            keys = read_keys_file(f"{entry.tmp_dir}/{entry.name}.keys")
+            if keys is None:  # submitted before keys files were written
+                try:
+                    keys = list(entry.load()._command_keys())
+                except Exception as e:
+                    logging.debug(f"Could not load {entry.json_fn}: {e}")
+                    continue
+            cache.harvest(entry.json_fn, num_success, keys, status_cache.exit_statuses())
+        cache.save()
+
+        num_commands = self.num_commands
+        signature = input_signature(self.input_files)
+        self.commands = [c for c in self.iter_commands()
+                         if command_key(c, signature) not in cache]
+        return num_commands - self.num_commands
+
     def _register_to_history(self):
         assert self.submit_time is not None
-        with open(f"{HISTORY_DIR}/{self.submit_time}.{self.name}.json", 'w') as f:
+        json_fn = f"{HISTORY_DIR}/{self.submit_time}.{self.name}.json"
+        with open(json_fn, 'w') as f:
             print(self.dumps(), file=f)
+        append_to_index(HISTORY_DIR, HistoryEntry.from_psub(self, json_fn))
 
     def _build_resource_string(self) -> str:
         l_str = []
@@ -255,7 +733,7 @@ class Psub:
         return ",".join(l_str)
 
     @classmethod
-    def parse_psub_command_string_to_command_list(cls, line_: str) -> List[str]:
+    def parse_psub_command_string(cls, line_: str) -> CommandGrid:
         command_string_l = line_.split(":::")
         command_template = command_string_l[0].strip()
 
@@ -270,22 +748,43 @@ class Psub:
                 str_args = argument.strip().split()
                 parameters.append(str_args)
 
-        num_fields = len(re.findall(r"{}", command_template))
-        assert num_fields == len(parameters), (
-            f"Mismatch between number of fields in template and number "
-            f"of parameters: {num_fields}, {len(parameters)} "
-        )
+        return CommandGrid(command_template, parameters)
 
-        parameter_combinations: Iterator[Tuple] = itertools.product(*parameters)
-        return [command_template.format(*c) for c in parameter_combinations]
+    @classmethod
+    def parse_psub_command_string_to_command_list(cls, line_: str) -> List[str]:
+        return list(cls.parse_psub_command_string(line_))
+
+    def _command_sources_for_history(self) -> List[dict]:
+        sources_d = []
+        start = 0
+        for source in self._command_sources:
+            if (isinstance(source, list) and len(source) > INLINE_COMMANDS_MAX
+                    and self.commands_sha256 is not None):
+                source = CommandsFileRange(
+                    self.commands_list_fn, start, len(source), self.commands_sha256
+                )
+            sources_d.append(source_to_dict(source))
+            start += len(source)
+        return sources_d
 
     def dumps(self):
-        return json.dumps(self.__dict__, indent=2)
+        public_d = {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+        public_d["format_version"] = HISTORY_FORMAT_VERSION
+        public_d["command_sources"] = self._command_sources_for_history()
+        return json.dumps(public_d, separators=(",", ":"))
 
     @classmethod
     def loads(cls, json_str):
         p = cls()
         d = json.loads(json_str)
+        d.pop("format_version", None)
+        if "job_id" in d:  # single ID, as briefly recorded before job_ids
+            job_id = d.pop("job_id")
+            d["job_ids"] = [job_id] if job_id is not None else []
+        if "command_sources" in d:
+            p._command_sources = [source_from_dict(sd) for sd in d.pop("command_sources")]
+        else:  # records from before format_version 2 list every command
+            p.commands = d.pop("commands", [])
         p.__dict__.update(d)
         return p
 
@@ -310,6 +809,60 @@ class Psub:
             psub_list, key=lambda x: x.submit_time, reverse=True
         )
 
+    @classmethod
+    def migrate_history(cls) -> int:
+        """Rewrite history records that list every command in the compact format.
+
+        :return: Number of records migrated
+        """
+        num_migrated = 0
+        for fn in sorted(glob(f"{HISTORY_DIR}/*.json")):
+            with open(fn) as f:
+                json_str = f.read()
+            try:
+                if "command_sources" in json.loads(json_str):
+                    continue
+            except json.JSONDecodeError:
+                print(f'Trouble loading {fn}')
+                continue
+
+            p = cls.loads(json_str)
+            # long lists can point at the commands file if it is still intact
+            if os.path.exists(p.commands_list_fn):
+                sha256 = file_sha256(p.commands_list_fn)
+                if sha256 == hash_commands(p.iter_commands()):
+                    p.commands_sha256 = sha256
+
+            tmp_fn = f"{fn}.tmp"
+            with open(tmp_fn, "w") as f:
+                print(p.dumps(), file=f)
+            os.replace(tmp_fn, fn)
+            num_migrated += 1
+
+        return num_migrated
+
+    @classmethod
+    def get_history_index(cls) -> List[HistoryEntry]:
+        """Lightweight history listing, most recent first.
+
+        Records from before the index existed are added to it the first time,
+        and entries whose record was deleted are left out.
+        """
+        json_fns = list_json_fns(HISTORY_DIR)
+        entries = existing_entries(read_index(HISTORY_DIR), json_fns)
+        for fn in unindexed_json_fns(HISTORY_DIR, entries, json_fns):
+            try:
+                p_ = cls.load(fn)
+            except json.JSONDecodeError:
+                print(f'Trouble loading {fn}')
+                continue
+            if p_.check_valid():
+                entry = HistoryEntry.from_psub(p_, fn)
+                append_to_index(HISTORY_DIR, entry)
+                entries.append(entry)
+
+        return sorted(entries, key=lambda x: x.submit_time, reverse=True)
+
     def check_valid(self):
         return self.submit_time is not None
 
@@ -1,7 +1,9 @@
 PSUB_MAIN = r"""
 TASKS_FILE=$1
-N_TASKS=$(cat $TASKS_FILE | wc -l)
 NUM_IN_BATCH=${{2:-1}}
+# a shard submits N_TASKS lines starting after LINE_OFFSET, by default the whole file
+LINE_OFFSET=${{3:-0}}
+N_TASKS=${{4:-$(cat $TASKS_FILE | wc -l)}}
 echo Submitting $N_TASKS tasks to the queue from $TASKS_FILE, with $NUM_IN_BATCH lines in each batch
 qsub <<CMD
 #!/bin/bash
@@ -11,12 +13,13 @@ qsub <<CMD
 #$ -V
 #$ -l {l_str}
 #$ -pe shared {num_cores}
-#$ -N $(basename $TASKS_FILE)_$RANDOM
-#$ -o {logdir}/job.\$TASK_ID.${{HOSTNAME}}.log
+#$ -N {job_name}
+#$ -o {logdir}/{sge_log_prefix}.\$TASK_ID.${{HOSTNAME}}.log
 #$ -m bae
-#$ -t 1-${{N_TASKS}}:${{NUM_IN_BATCH}}
+#$ -t {task_range}
+{scheduler_options}
 {pre_task_runner_script}
-{tmpdir}/run_task.sh ${{TASKS_FILE}} ${{NUM_IN_BATCH}} {tmpdir}
+{tmpdir}/{task_runner} ${{TASKS_FILE}} ${{NUM_IN_BATCH}} {tmpdir} {num_workers} {logdir} {max_attempts} ${{LINE_OFFSET}}
 {post_task_runner_script}
 sleep $((11-SECONDS)) 2> /dev/null
 CMD
@@ -26,11 +29,150 @@ RUN_TASK = r"""
 TASKS_FILE=$1
 NUM_IN_BATCH=$2
 TMPDIR=$3
-for ((i=0; i<${NUM_IN_BATCH}; i++)); do
-    LINE_NUM=$((SGE_TASK_ID+i))
-    CMD=$(awk "NR==$LINE_NUM" $TASKS_FILE)
-    echo "started $(date +%s)" > ${TMPDIR}/exit_status/${LINE_NUM}
-    eval $CMD
+NUM_WORKERS=${4:-1}
+LOGDIR=$5
+LINE_OFFSET=${7:-0}  # task IDs of a shard count from its first line
+INDEX_FILE=${TASKS_FILE%.sh}.idx
+FIRST_LINE=$((SGE_TASK_ID+LINE_OFFSET))
+LAST_LINE=$((FIRST_LINE+NUM_IN_BATCH-1))
+if [ -f "$INDEX_FILE" ]; then
+    # seek straight to this task's block using the uint64 line offset index
+    N_LINES=$(( $(stat -c %s "$INDEX_FILE") / 8 - 1 ))
+    (( LAST_LINE > N_LINES )) && LAST_LINE=$N_LINES
+    read -r BLOCK_START < <(od -An -t u8 -j $(( (FIRST_LINE-1)*8 )) -N 8 "$INDEX_FILE")
+    read -r BLOCK_END < <(od -An -t u8 -j $(( LAST_LINE*8 )) -N 8 "$INDEX_FILE")
+    read_batch() { tail -c +$((BLOCK_START+1)) "$TASKS_FILE" | head -c $((BLOCK_END-BLOCK_START)); }
+else
+    read_batch() { awk -v a=$FIRST_LINE -v b=$LAST_LINE 'NR>=a && NR<=b' "$TASKS_FILE"; }
+fi
+# fixed-size records appended to one ledger per host, see psub/exit_status.py
+LEDGER=${TMPDIR}/exit_status/ledger.${HOSTNAME:-$(hostname)}
+record_status() { printf '%12d %s %12d %5d %-29.29s\n' "$LINE_NUM" "$1" "$(date +%s)" "$2" "${HOSTNAME:-$(hostname)}" >> "$LEDGER"; }
+# wall time, user and system CPU seconds and peak RSS in KB of each command, see psub/exit_status.py
+USAGE_LEDGER=${TMPDIR}/exit_status/usage.${HOSTNAME:-$(hostname)}
+if [ -x /usr/bin/time ] && [ -z "$PSUB_NO_GNU_TIME" ]; then
+    timed() { /usr/bin/time -f "%e %U %S %M" -o "$1" bash -c "$2"; }
+else
+    timed() { ${TMPDIR}/time_command.py "$1" "$2"; }
+fi
+record_usage() {
+    local WALL USER_CPU SYS_CPU MAX_RSS
+    [ -s "$1" ] && read -r WALL USER_CPU SYS_CPU MAX_RSS < <(tail -n 1 "$1")
+    rm -f "$1"
+    [[ "$WALL $USER_CPU $SYS_CPU $MAX_RSS" =~ ^[0-9.]+\ [0-9.]+\ [0-9.]+\ [0-9]+$ ]] || return
+    printf '%12d %11.2f %11.2f %11.2f %14d\n' "$LINE_NUM" "$WALL" "$USER_CPU" "$SYS_CPU" "$MAX_RSS" >> "$USAGE_LEDGER"
+}
+run_line() {
+    local LINE_NUM=$1 CMD=$2
+    local USAGE_FN=${TMPDIR}/exit_status/.usage.${HOSTNAME:-$(hostname)}.$1
+    record_status S -1
+    timed "$USAGE_FN" "$CMD"  # own process, so an "exit" in the command still gets recorded
     EXIT_STATUS=$?
-    echo "${EXIT_STATUS} $(date +%s)" > ${TMPDIR}/exit_status/${LINE_NUM}
-done"""
+    record_status E ${EXIT_STATUS}
+    record_usage "$USAGE_FN"
+    # queue workers re-enqueue failed lines
+    if [ -n "$PSUB_FAILED_LINES" ] && (( EXIT_STATUS != 0 )); then
+        echo $LINE_NUM >> "$PSUB_FAILED_LINES"
+    fi
+}
+LINE_NUM=$FIRST_LINE
+while IFS= read -r CMD <&3; do
+    if (( NUM_WORKERS > 1 )); then
+        # packed: keep NUM_WORKERS commands running, each with its own log
+        while (( $(jobs -rp | wc -l) >= NUM_WORKERS )); do
+            wait -n 2> /dev/null || sleep 0.2
+        done
+        run_line $LINE_NUM "$CMD" > ${LOGDIR}/job.${LINE_NUM}.${HOSTNAME}.log 2>&1 3<&- &
+    elif [ -n "$PSUB_LINE_LOGS" ]; then
+        # queue workers run many batches and shards renumber their tasks,
+        # so the task log can't stand in for the command's
+        run_line $LINE_NUM "$CMD" > ${LOGDIR}/job.${LINE_NUM}.${HOSTNAME}.log 2>&1 3<&-
+    else
+        run_line $LINE_NUM "$CMD"
+    fi
+    LINE_NUM=$((LINE_NUM+1))
+done 3< <(read_batch)
+wait"""
+
+RUN_QUEUE_WORKER = r"""
+TASKS_FILE=$1
+NUM_IN_BATCH=$2
+TMPDIR=$3
+NUM_WORKERS=$4
+LOGDIR=$5
+MAX_ATTEMPTS=${6:-1}
+QUEUE=${TMPDIR}/queue
+WORKER=${HOSTNAME:-$(hostname)}.$$
+FAILED_LINES=${QUEUE}/failed.${WORKER}
+# batches are handed out in order from the cursor file, "<next line> <number of lines>",
+# under a lock; only commands to rerun get a <line>.1.<attempt> token in pending/,
+# which a worker owns once it manages to rename the token into claimed/
+next_batch() {
+    (
+        flock 9
+        read -r NEXT NUM_LINES < "$QUEUE/cursor"
+        (( NEXT > NUM_LINES )) && exit
+        COUNT=$(( NUM_LINES - NEXT + 1 < NUM_IN_BATCH ? NUM_LINES - NEXT + 1 : NUM_IN_BATCH ))
+        echo "$((NEXT + COUNT)) $NUM_LINES" > "$QUEUE/cursor.tmp"
+        mv "$QUEUE/cursor.tmp" "$QUEUE/cursor"
+        echo "$NEXT.$COUNT.1"
+    ) 9> "$QUEUE/cursor.lock"
+}
+next_retry() {
+    for CANDIDATE in $(ls "$QUEUE/pending" | shuf -n 16); do
+        if mv "$QUEUE/pending/$CANDIDATE" "$QUEUE/claimed/$CANDIDATE.$WORKER" 2> /dev/null; then
+            echo "$CANDIDATE"
+            return
+        fi
+    done
+}
+BACKOFF=1
+while true; do
+    TOKEN=$(next_batch)
+    if [ -n "$TOKEN" ]; then
+        touch "$QUEUE/claimed/$TOKEN.$WORKER"
+    else
+        TOKEN=$(next_retry)
+    fi
+    if [ -z "$TOKEN" ]; then
+        # drained, each worker reruns its own failures before it gets here
+        [ -z "$(ls "$QUEUE/pending")" ] && break
+        sleep $(( RANDOM % BACKOFF + 1 ))  # lost every race, let the others take theirs
+        BACKOFF=$(( BACKOFF < 16 ? BACKOFF * 2 : 32 ))
+        continue
+    fi
+    BACKOFF=1
+    IFS=. read -r FIRST_LINE COUNT ATTEMPT <<< "$TOKEN"
+    : > "$FAILED_LINES"
+    SGE_TASK_ID=$FIRST_LINE PSUB_FAILED_LINES=$FAILED_LINES PSUB_LINE_LOGS=1 \
+        ${TMPDIR}/run_task.sh "$TASKS_FILE" "$COUNT" "$TMPDIR" "$NUM_WORKERS" "$LOGDIR"
+    if (( ATTEMPT < MAX_ATTEMPTS )); then
+        while read -r LINE_NUM; do
+            touch "$QUEUE/pending/$LINE_NUM.1.$((ATTEMPT+1))"
+        done < "$FAILED_LINES"
+    fi
+    rm -f "$QUEUE/claimed/$TOKEN.$WORKER"
+done
+rm -f "$FAILED_LINES"
+"""
+
+TIME_COMMAND = r"""
+# Runs a command with bash and writes "<wall> <user cpu> <system cpu> <max rss KB>"
+# to a file, like /usr/bin/time -f "%e %U %S %M" -o FILE, for nodes without GNU time
+import os
+import subprocess
+import sys
+import time
+
+usage_fn, command = sys.argv[1:3]
+start = time.monotonic()
+proc = subprocess.Popen(["bash", "-c", command])
+_, wait_status, rusage = os.wait4(proc.pid, 0)
+wall = time.monotonic() - start
+with open(usage_fn, "w") as f:
+    print(f"{wall:.2f} {rusage.ru_utime:.2f} {rusage.ru_stime:.2f} {rusage.ru_maxrss}", file=f)
+# by hand, os.waitstatus_to_exitcode needs Python 3.9; signals are reported the way bash does
+if os.WIFSIGNALED(wait_status):
+    sys.exit(128 + os.WTERMSIG(wait_status))
+sys.exit(os.WEXITSTATUS(wait_status))
+"""
@@ -0,0 +1,180 @@
+"""Adaptive cap on the number of concurrently running array tasks.
+
+``ConcurrencyController`` follows the exit status records of a running job
+and moves its ``-tc`` limit with ``qalter``: it halves the limit when the
+commands that ended recently fail more often than ``max_failure_rate`` or
+take ``slowdown`` times longer than the fastest window seen so far, which is
+what I/O-bound tasks do when shared storage or a license server saturates,
+and raises it step by step while they run well.
+"""
+import logging
+import subprocess
+import time
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from psub.batching import percentile
+from psub.exit_status import (
+    StatusCache, STARTED, ENDED, OUTCOME_STARTED, POLLING_SAVE_INTERVAL
+)
+
+DEFAULT_INTERVAL = 60.0
+DEFAULT_WINDOW = 600.0
+DEFAULT_MIN_SAMPLES = 10
+DEFAULT_MAX_FAILURE_RATE = 0.1
+DEFAULT_SLOWDOWN = 1.5
+DEFAULT_DECREASE = 0.5
+DEFAULT_INCREASE = 0.2
+
+
+class WindowStats(NamedTuple):
+    num_ended: int
+    failure_rate: float
+    median_duration: Optional[float]
+
+
+class ThrottleDecision(NamedTuple):
+    limit: int
+    reason: str
+
+
+def per_array_limit(limit: int, num_arrays: int) -> int:
+    """-tc for each of ``num_arrays`` arrays, so that together they stay within ``limit``.
+
+    Rounded down, and every array needs at least one slot, so ``limit`` can't
+    be below ``num_arrays``.
+    """
+    num_arrays = max(1, num_arrays)
+    if limit < num_arrays:
+        raise ValueError(f"{limit} concurrent tasks can't be shared by {num_arrays} arrays, "
+                         f"raise the limit or shard_size")
+    return limit // num_arrays
+
+
+def qalter_tc(job_ids: List[int], limit: int):
+    """Share ``limit`` between the arrays ``job_ids``.
+
+    An array can finish between the qstat that listed it and its qalter, so a
+    failed qalter is logged rather than raised.
+    """
+    per_array = per_array_limit(limit, len(job_ids))
+    for job_id in job_ids:
+        cp = subprocess.run(["qalter", "-tc", str(per_array), str(job_id)],
+                            capture_output=True, universal_newlines=True)
+        if cp.returncode != 0:
+            logging.info(f"qalter -tc {per_array} {job_id} failed, it may have finished: "
+                         f"{cp.stderr.strip()}")
+
+
+class ConcurrencyController:
+    """
+    :param min_limit: Never go below this many concurrent tasks
+    :param max_limit: Never go above this many
+    :param window: Seconds of recently ended commands to judge by
+    :param min_samples: Commands a window needs before the limit is changed
+    :param max_failure_rate: Share of failed commands that lowers the limit
+    :param slowdown: Lower the limit when the median duration exceeds the
+        best window median seen by this factor
+    :param decrease: Factor the limit is multiplied by when lowering it
+    :param increase: Fraction of the limit (at least 1) added when raising it
+    """
+
+    def __init__(self, p, min_limit: int = 1, max_limit: int = None,
+                 window: float = DEFAULT_WINDOW, min_samples: int = DEFAULT_MIN_SAMPLES,
+                 max_failure_rate: float = DEFAULT_MAX_FAILURE_RATE,
+                 slowdown: float = DEFAULT_SLOWDOWN, decrease: float = DEFAULT_DECREASE,
+                 increase: float = DEFAULT_INCREASE):
+        self.p = p
+        # each of the job's arrays runs at least one task
+        self.min_limit = max(min_limit, len(p.job_ids))
+        self.max_limit = max_limit if max_limit is not None else p.num_commands
+        self.window = window
+        self.min_samples = min_samples
+        self.max_failure_rate = max_failure_rate
+        self.slowdown = slowdown
+        self.decrease = decrease
+        self.increase = increase
+
+        self.status_cache = StatusCache(f"{p.tmp_dir}/exit_status",
+                                        save_interval=POLLING_SAVE_INTERVAL)
+        self.status_cache.track_new = True
+
+        if p.max_concurrent is not None:
+            self.limit = p.max_concurrent
+        else:  # start from the number of commands running now
+            running = self.status_cache.refresh().counts[OUTCOME_STARTED]
+            self.limit = min(self.max_limit, max(self.min_limit, running))
+        self.baseline_duration: Optional[float] = None
+        self._started: Dict[int, int] = {}
+        self._ended: Deque[Tuple[int, int, bool]] = deque()  # (end time, duration, failed)
+
+    def _read_new_records(self):
+        self.status_cache.refresh()
+        for r in sorted(self.status_cache.pop_new_records(), key=lambda r: r.sort_key):
+            if r.state == STARTED:
+                self._started[r.line] = r.timestamp
+            elif r.state == ENDED and r.line in self._started:
+                duration = r.timestamp - self._started.pop(r.line)
+                self._ended.append((r.timestamp, duration, r.exit_code != 0))
+
+    def window_stats(self, now: float = None) -> WindowStats:
+        self._read_new_records()
+        now = time.time() if now is None else now
+        while self._ended and self._ended[0][0] < now - self.window:
+            self._ended.popleft()
+
+        if not self._ended:
+            return WindowStats(0, 0.0, None)
+        failures = sum(failed for _, _, failed in self._ended)
+        durations = [duration for _, duration, failed in self._ended if not failed]
+        return WindowStats(
+            len(self._ended),
+            failures / len(self._ended),
+            percentile(durations, 0.5) if durations else None,
+        )
+
+    def decide(self, stats: WindowStats) -> ThrottleDecision:
+        if stats.num_ended < self.min_samples:
+            return ThrottleDecision(self.limit, f"only {stats.num_ended} commands ended recently")
+
+        lower = max(self.min_limit, int(self.limit * self.decrease))
+        if stats.failure_rate > self.max_failure_rate:
+            return ThrottleDecision(lower, f"{stats.failure_rate:.0%} of recent commands failed")
+
+        if stats.median_duration is not None:
+            if self.baseline_duration is None or stats.median_duration < self.baseline_duration:
+                self.baseline_duration = stats.median_duration
+            elif stats.median_duration > self.slowdown * self.baseline_duration:
+                return ThrottleDecision(
+                    lower,
+                    f"median duration {stats.median_duration:.0f} s, "
+                    f"up from {self.baseline_duration:.0f} s",
+                )
+
+        higher = min(self.max_limit, self.limit + max(1, int(self.limit * self.increase)))
+        return ThrottleDecision(higher, "recent commands ran well")
+
+    def step(self, now: float = None) -> ThrottleDecision:
+        """Look at the latest records and apply the new limit if it changed."""
+        decision = self.decide(self.window_stats(now))
+        if decision.limit != self.limit:
+            logging.info(f"{self.p.name}: -tc {self.limit} -> {decision.limit}, {decision.reason}")
+            self.p.set_max_concurrent(decision.limit)
+            self.limit = decision.limit
+            # judge the new limit only by commands that end under it
+            self._ended.clear()
+        return decision
+
+    def run(self, interval: float = DEFAULT_INTERVAL, verbose: bool = True):
+        """Adjust the limit every ``interval`` seconds until the job has ended."""
+        while True:
+            decision = self.step()
+            if verbose:
+                print(f"{time.strftime('%H:%M:%S')} {self.p.name}: "
+                      f"-tc {decision.limit} ({decision.reason})")
+            if self._job_done():
+                return
+            time.sleep(interval)
+
+    def _job_done(self) -> bool:
+        return self.p._all_ended(self.status_cache.counts) or self.p._left_queue()
@@ -0,0 +1,76 @@
+"""Concurrent CPU utilisation probes of the nodes running interactive jobs.
+
+Each node runs ``sge_check_cpu_util.py`` over ssh, which samples for a few
+seconds. All nodes are probed at once (up to ``max_concurrent``), a node that
+hosts several jobs is probed only once, and ssh multiplexes over a
+ControlMaster connection so repeated probes skip the handshake.
+"""
+import asyncio
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+SGE_CHECK_CPU_UTIL_FN = f"{Path(__file__).parents[0].absolute()}/sge_check_cpu_util.py"
+
+SSH_OPTIONS = [
+    "-o", "BatchMode=yes",
+    "-o", "ControlMaster=auto",
+    "-o", "ControlPath=~/.ssh/psub-cm-%r@%h:%p",
+    "-o", "ControlPersist=10m",
+]
+DEFAULT_MAX_CONCURRENT = 16
+DEFAULT_TIMEOUT = 20.0
+
+
+class ProbeResult(NamedTuple):
+    node: str
+    cpu_usage: Optional[str]
+    error: Optional[str]
+    jobs: list  # sge_monitor.Job records running on the node
+
+
+async def probe_node(node: str, semaphore: asyncio.Semaphore, timeout: float = DEFAULT_TIMEOUT,
+                     ssh_cmd: str = "ssh") -> Tuple[Optional[str], Optional[str]]:
+    """:return: CPU usage as printed by the probe script, or an error"""
+    async with semaphore:
+        proc = await asyncio.create_subprocess_exec(
+            ssh_cmd, *SSH_OPTIONS, node, "python", SGE_CHECK_CPU_UTIL_FN,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return None, f"timed out after {timeout:.0f} s"
+
+    if proc.returncode != 0:
+        return None, stderr.decode().strip() or f"ssh exited with status {proc.returncode}"
+    return stdout.decode().strip(), None
+
+
+async def probe_nodes(nodes: List[str], max_concurrent: int = DEFAULT_MAX_CONCURRENT,
+                      timeout: float = DEFAULT_TIMEOUT,
+                      ssh_cmd: str = "ssh") -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+    semaphore = asyncio.Semaphore(max_concurrent)
+    results = await asyncio.gather(
+        *[probe_node(node, semaphore, timeout, ssh_cmd) for node in nodes]
+    )
+    return dict(zip(nodes, results))
+
+
+def probe_interactive_nodes(job_list, max_concurrent: int = DEFAULT_MAX_CONCURRENT,
+                            timeout: float = DEFAULT_TIMEOUT,
+                            ssh_cmd: str = "ssh") -> List[ProbeResult]:
+    """Probe every node with a QRLOGIN job in ``job_list``, each node once."""
+    jobs_by_node: Dict[str, list] = {}
+    for job in job_list:
+        if job.JB_name == 'QRLOGIN' and job.queue_name is not None:
+            jobs_by_node.setdefault(job.queue_name.split('@')[-1], []).append(job)
+
+    if not jobs_by_node:
+        return []
+
+    results = asyncio.run(probe_nodes(list(jobs_by_node), max_concurrent, timeout, ssh_cmd))
+    return [ProbeResult(node, cpu_usage, error, jobs_by_node[node])
+            for node, (cpu_usage, error) in results.items()]
@@ -0,0 +1,88 @@
+"""Shared, short-lived snapshot of ``qstat -u $USER -xml``.
+
+Every monitor (``sge_monitor``, the textual TUI, ``check_cpu_on_interactive``)
+and ``psub`` itself asks for the job list through here. The raw XML is kept on
+disk for ``ttl`` seconds and refreshed under a file lock, which orders
+processes, and a thread lock, which orders the threads of one process, so
+however many of them are open, the scheduler sees one query per interval.
+"""
+import fcntl
+import getpass
+import logging
+import os
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Tuple
+
+USER = os.environ.get('USER') or getpass.getuser()
+
+SNAPSHOT_FN = f"{Path.home()}/.psub/qstat_snapshot.xml"
+DEFAULT_TTL = 3.0
+MAX_FALLBACK_AGE = 300.0  # oldest snapshot that stands in for a failed qstat
+
+# lockf locks belong to the process, so they don't keep its own threads apart
+_refresh_lock = threading.Lock()
+
+
+class StaleSnapshotError(OSError):
+    """qstat failed and the snapshot on disk is older than the caller can use."""
+
+
+def _read_snapshot(snapshot_fn: str, ttl: float):
+    try:
+        st = os.stat(snapshot_fn)
+    except FileNotFoundError:
+        return None
+    if time.time() - st.st_mtime >= ttl:
+        return None
+    with open(snapshot_fn, "rb") as f:
+        return f.read(), st.st_mtime
+
+
+def _query_qstat() -> bytes:
+    cp = subprocess.run(["qstat", "-u", USER, "-xml"], capture_output=True, check=True)
+    return cp.stdout
+
+
+def get_qstat_xml(ttl: float = DEFAULT_TTL, snapshot_fn: str = None,
+                  max_fallback_age: float = MAX_FALLBACK_AGE) -> Tuple[bytes, float]:
+    """qstat XML no older than ``ttl`` seconds, or when qstat fails, no older
+    than ``max_fallback_age``.
+
+    :return: The XML and the time it was taken
+    """
+    snapshot_fn = SNAPSHOT_FN if snapshot_fn is None else snapshot_fn
+
+    snapshot = _read_snapshot(snapshot_fn, ttl)
+    if snapshot is not None:
+        return snapshot
+
+    os.makedirs(os.path.dirname(snapshot_fn), exist_ok=True)
+    with _refresh_lock, open(f"{snapshot_fn}.lock", "w") as lock_f:
+        try:
+            fcntl.lockf(lock_f, fcntl.LOCK_EX)
+        except OSError as e:  # some network filesystems refuse locks
+            logging.debug(f"Could not lock {snapshot_fn}: {e}")
+
+        # another process or thread may have refreshed it while we waited for the locks
+        snapshot = _read_snapshot(snapshot_fn, ttl)
+        if snapshot is not None:
+            return snapshot
+
+        try:
+            xml_ = _query_qstat()
+        except (subprocess.CalledProcessError, OSError) as e:
+            snapshot = _read_snapshot(snapshot_fn, max_fallback_age)
+            if snapshot is None:  # none, or too old to say what is still queued
+                raise
+            logging.debug(f"qstat failed, reusing the previous snapshot: {e}")
+            return snapshot
+
+        tmp_fn = f"{snapshot_fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_fn, "wb") as f:
+            f.write(xml_)
+        os.replace(tmp_fn, snapshot_fn)
+
+    return xml_, os.stat(snapshot_fn).st_mtime
@@ -1,21 +1,26 @@
-import os
+import argparse
+import functools
+import io
+import logging
+import re
+import threading
 import time
 import sys
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
 import shutil
-from pathlib import Path
-import xml.etree.cElementTree as ET
+import xml.etree.ElementTree as ET
+
+from psub.main import Psub
+from psub.utilities.cpu_probe import probe_interactive_nodes
+from psub.utilities.qstat_snapshot import get_qstat_xml, DEFAULT_TTL, StaleSnapshotError
 
 """ Monitor jobs on SGE
 
 Updates status every minute
 """
 
-USER = os.environ['USER']
-
-
 class AnsiCommands:
     """https://stackoverflow.com/questions/287871/"""
 
@@ -35,171 +40,407 @@ class AnsiCommands:
     CLEAR_SCREEN = '\033[2J'
 
 
+def _parse_qstat_time(text: str) -> datetime:
+    return datetime.fromisoformat(text)
+
+
 class Job:
+    """One ``job_list`` element of qstat's XML output."""
+
+    FIELD_TYPES = {
+        'JB_job_number': int,
+        'JAT_prio': float,
+        'JB_name': str,
+        'JB_owner': str,
+        'state': str,
+        'JAT_start_time': _parse_qstat_time,
+        'JB_submission_time': _parse_qstat_time,
+        'queue_name': str,
+        'slots': int,
+        'tasks': str,
+    }
+
+    __slots__ = tuple(FIELD_TYPES) + ('node_name',)
+
+    def __init__(self, **fields):
+        for k in self.__slots__:
+            setattr(self, k, fields.get(k))
 
     def __repr__(self):
-        return str(self.__dict__)
+        return str({k: getattr(self, k) for k in self.__slots__})
 
-    def one_line_rep(self, line_max=79, color=True) -> str:
-        if line_max < 80:
-            line_max = 79
+    def elapsed_str(self, now: datetime = None) -> str:
+        job_time = next(
+            (t for t in [self.JAT_start_time, self.JB_submission_time] if t is not None), None)
+        if job_time is None:
+            return ''
+        timediff = (now or datetime.now()) - job_time
+        return str(timediff).split('.')[0]
+
+    def one_line_rep(self, line_max=79, color=True, now: datetime = None) -> str:
+        job_time = self.elapsed_str(now)
+        before_time, after_time = _one_line_template(
+            self.JB_job_number, self.state or 'unknown', self.JB_name, self.queue_name,
+            self.tasks or '', self.slots, line_max, color, len(job_time)
+        )
+        return before_time + job_time + after_time
+
+
+@functools.lru_cache(maxsize=4096)
+def _one_line_template(job_number, job_state, job_name, queue_name, tasks, job_slots,
+                       line_max, color, time_len) -> Tuple[str, str]:
+    """Everything in a job's line except the elapsed time, which changes every redraw."""
+    if line_max < 80:
+        line_max = 79
+
+    job_time = '#' * time_len
+    job_queue = queue_name if queue_name is not None else "-"
+
+    job_name_ = ""
+    s_ = f"{job_number}: {job_state} ➜ {job_name_} | {job_time} | {job_queue} {tasks} n{job_slots}"
+
+    job_name_len = line_max - len(s_)
+
+    job_name_ = job_name[:job_name_len - 3] + '...' if len(
+        job_name) > job_name_len else job_name
+
+    s_2 = f"{job_number}: {job_state} ➜ {job_name_} | {job_time} | {job_queue} {tasks} n{job_slots}"
+    slack = line_max - len(s_2) + len(job_name_)
+
+    if color:
+        col_ = AnsiCommands.OKGREEN if job_state == 'r' else AnsiCommands.OKBLUE
+        col_end = AnsiCommands.ENDC
+    else:
+        col_ = ''
+        col_end = ''
+
+    return (f"{job_number}: {col_}{job_state} ➜ {job_name_:<{slack}}{col_end} | ",
+            f" | {job_queue} {tasks} n{job_slots}")
+
+
+def count_tasks(tasks: str) -> int:
+    """Number of tasks in a qstat task list such as ``4-100:2,101``."""
+    if not tasks:
+        return 1
+    num_tasks = 0
+    for part in tasks.split(','):
+        m = re.fullmatch(r"(\d+)-(\d+):(\d+)", part)
+        if m:
+            first, last, step = map(int, m.groups())
+            num_tasks += (last - first) // step + 1
+        else:
+            num_tasks += 1
+    return num_tasks
 
-        job_number = self.JB_job_number
-        job_name = self.JB_name
-        job_state = getattr(self, 'state', 'unknown')
 
-        job_start_time = getattr(self, 'JAT_start_time', None)
-        job_submission_time = getattr(self, 'JB_submission_time', None)
+# PSUB_MAIN names jobs after the commands file, -N {psub name}.commands.sh;
+# the optional _<number> suffix is for jobs submitted by older versions, which
+# appended $RANDOM
+PSUB_JOB_NAME_RE = re.compile(r"(?P<name>.+)\.commands\.sh(_\d+)?")
 
-        job_time = next(
-            (t for t in [job_start_time, job_submission_time] if t is not None), '')
-        timediff = datetime.now() - datetime.fromisoformat(job_time)
-        job_time = str(timediff).split('.')[0]
 
-        job_queue = self.queue_name if self.queue_name is not None else "-"
-        job_slots = self.slots
+class ArraySummary:
+    """All tasks of one array job, shown as a single row."""
+
+    def __init__(self, job_number: int, job_name: str):
+        self.job_number = job_number
+        self.job_name = job_name
+
+        self.running = 0
+        self.queued = 0
+        self.errors = 0
+        self.first_start_time = None
+        self.last_start_time = None
+        self.hosts = set()
+
+        self.psub_status = None
 
-        tasks = getattr(self, 'tasks', '')
+    def add(self, job: Job):
+        num_tasks = count_tasks(job.tasks)
+        state = job.state or ''
+        if 'E' in state:
+            self.errors += num_tasks
+        elif 'q' in state:
+            self.queued += num_tasks
+        else:
+            self.running += num_tasks
 
-        job_name_ = ""
-        s_ = f"{job_number}: {job_state} ➜ {job_name_} | {job_time} | {job_queue} {tasks} n{job_slots}"
+        if job.JAT_start_time is not None:
+            if self.first_start_time is None or job.JAT_start_time < self.first_start_time:
+                self.first_start_time = job.JAT_start_time
+            if self.last_start_time is None or job.JAT_start_time > self.last_start_time:
+                self.last_start_time = job.JAT_start_time
+        if job.queue_name is not None:
+            self.hosts.add(job.queue_name.split('@')[-1])
 
-        job_name_len = line_max - len(s_)
+    def one_line_rep(self, line_max=79, color=True, now: datetime = None) -> str:
+        if line_max < 80:
+            line_max = 79
+        now = now or datetime.now()
 
-        job_name_ = job_name[:job_name_len - 3] + '...' if len(
-            job_name) > job_name_len else job_name
+        if self.first_start_time is not None:
+            longest = str(now - self.first_start_time).split('.')[0]
+            shortest = str(now - self.last_start_time).split('.')[0]
+            job_time = longest if longest == shortest else f"{shortest}-{longest}"
+        else:
+            job_time = '-'
 
-        s_2 = f"{job_number}: {job_state} ➜ {job_name_} | {job_time} | {job_queue} {tasks} n{job_slots}"
-        slack = line_max - len(s_2) + len(job_name_)
+        hosts = ','.join(sorted(self.hosts)) if len(self.hosts) <= 2 else f"{len(self.hosts)} hosts"
+        psub_status = f" | psub: {self.psub_status}" if self.psub_status is not None else ''
+        rest = (f" | r{self.running} qw{self.queued} E{self.errors} | {job_time} | "
+                f"{hosts or '-'}{psub_status}")
+
+        prefix = f"{self.job_number}: array ➜ "
+        job_name_len = max(line_max - len(prefix) - len(rest), 5)
+        job_name_ = self.job_name[:job_name_len - 3] + '...' if len(
+            self.job_name) > job_name_len else self.job_name
 
         if color:
-            col_ = AnsiCommands.OKGREEN if job_state == 'r' else AnsiCommands.OKBLUE
+            col_ = AnsiCommands.FAIL if self.errors else (
+                AnsiCommands.OKGREEN if self.running else AnsiCommands.OKBLUE)
             col_end = AnsiCommands.ENDC
         else:
             col_ = ''
             col_end = ''
 
-        return f"{job_number}: {col_}{job_state} ➜ {job_name_:<{slack}}{col_end} | {job_time} | {job_queue} {tasks} n{job_slots}"
-
-
-def etree_to_dict(t):
-    d = {t.tag: {} if t.attrib else None}
-    children = list(t)
-    if children:
-        dd = defaultdict(list)
-        for dc in map(etree_to_dict, children):
-            for k, v in dc.items():
-                dd[k].append(v)
-        d = {t.tag: {k: v[0] if len(v) == 1 else v for k, v in dd.items()}}
-    if t.attrib:
-        d[t.tag].update(('@' + k, v) for k, v in t.attrib.items())
-    if t.text:
-        text = t.text.strip()
-        if children or t.attrib:
-            if text:
-                d[t.tag]['#text'] = text
-        else:
-            d[t.tag] = text
-    return d
+        return f"{self.job_number}: {col_}array ➜ {job_name_:<{job_name_len}}{col_end}{rest}"
 
 
-def get_job_list(dd):
-    job_list = []
+DEFAULT_STATUS_INTERVAL = 30.0
 
-    try:
-        l1 = dd['job_info']['queue_info']['job_list']
-    except Exception:
-        l1 = []
 
+def psub_status(entry, job_list: List[Job]) -> Optional[str]:
     try:
-        l2 = dd['job_info']['job_info']['job_list']
-    except Exception:
-        l2 = []
+        return entry.load().get_status(job_list)
+    except Exception as e:
+        logging.debug(f"Could not get psub status of {entry.name}: {e}")
+        return None
+
+
+class PsubStatuses:
+    """psub statuses of history entries, worked out on a background thread.
+
+    A status reads the job's exit status ledgers, which can be slow on a network
+    filesystem, so rows show the last status known and each is refreshed at
+    most every ``interval`` seconds without holding up the screen.
+    """
+
+    def __init__(self, interval: float = DEFAULT_STATUS_INTERVAL):
+        self.interval = interval
+        self._statuses: Dict[str, Tuple[float, Optional[str]]] = {}  # name -> (computed at, status)
+        self._refreshing = set()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, entry, job_list: List[Job]) -> Optional[str]:
+        with self._lock:
+            computed_at, status = self._statuses.get(entry.name, (None, None))
+            if entry.name not in self._refreshing and (
+                    computed_at is None or time.monotonic() - computed_at >= self.interval):
+                self._refreshing.add(entry.name)
+                self._executor.submit(self._refresh, entry, job_list)
+        return status
+
+    def _refresh(self, entry, job_list: List[Job]):
+        if self._closed:  # don't hold up exiting with the ones still queued
+            return
+        status = psub_status(entry, job_list)
+        with self._lock:
+            self._statuses[entry.name] = (time.monotonic(), status)
+            self._refreshing.discard(entry.name)
+
+    def close(self, wait: bool = True):
+        """:param wait: Finish the statuses already asked for, rather than drop them"""
+        self._closed = not wait
+        self._executor.shutdown(wait=wait)
+
+
+def summarize_jobs(job_list: List[Job], history_entries=None,
+                   psub_statuses: PsubStatuses = None) -> list:
+    """Collapse the per-task rows of array jobs into one ArraySummary each.
+
+    Arrays submitted by psub are matched to their history entry by job ID, or
+    by job name for entries from before IDs were recorded, so psub's own
+    progress can be shown alongside the scheduler's view. Without
+    ``psub_statuses`` the statuses are worked out here, one by one.
+    """
+    history_by_name = {e.name: e for e in history_entries or []}
+    history_by_job_id = {job_id: e for e in history_entries or [] for job_id in e.job_ids}
+
+    rows = []
+    summaries = {}
+    array_numbers = {j.JB_job_number for j in job_list if j.tasks is not None}
+    for job in job_list:
+        if job.JB_job_number not in array_numbers:
+            rows.append(job)
+            continue
+        summary = summaries.get(job.JB_job_number)
+        if summary is None:
+            summary = summaries[job.JB_job_number] = ArraySummary(job.JB_job_number, job.JB_name)
+            rows.append(summary)
+        summary.add(job)
+
+    for summary in summaries.values():
+        entry = history_by_job_id.get(summary.job_number)
+        if entry is None:
+            m = PSUB_JOB_NAME_RE.fullmatch(summary.job_name)
+            entry = history_by_name.get(m.group('name')) if m else None
+        if entry is None:
+            continue
+        if psub_statuses is not None:
+            summary.psub_status = psub_statuses.get(entry, job_list)
+        else:
+            summary.psub_status = psub_status(entry, job_list)
+
+    return rows
+
+
+def iter_jobs(source) -> Iterator[Job]:
+    """Stream ``Job`` records out of qstat XML (a path or binary file object).
 
-    for ll in [l1, l2]:
-        if not isinstance(ll, list):
-            ll = [ll]
+    Each ``job_list`` element is cleared as soon as its job has been read, so
+    memory stays flat however many pending tasks are listed.
+    """
+    field_types = Job.FIELD_TYPES
+    fields = {}
+    for _, elem in ET.iterparse(source):
+        tag = elem.tag
+        if tag == "job_list":
+            yield Job(**fields)
+            fields = {}
+            elem.clear()
+        elif tag in field_types:
+            text = elem.text.strip() if elem.text else ''
+            fields[tag] = field_types[tag](text) if text else None
 
-        job_list += ll
 
-    jobs = []
-    for job_d in job_list:
-        j = Job()
-        j.__dict__.update(job_d)
-        jobs.append(j)
+def parse_job_list(xml_: bytes) -> List[Job]:
+    return list(iter_jobs(io.BytesIO(xml_)))
 
-    return jobs
 
+_parsed_snapshot = (None, [])  # (time the qstat snapshot was taken, job list)
 
-def get_job_list_direct():
-    cp = subprocess.run(f'qstat -u {USER} -xml', capture_output=True, shell=True)
-    xml_ = cp.stdout.decode()
 
-    e = ET.XML(xml_)
+def get_job_list_direct(ttl=DEFAULT_TTL, not_before: float = None):
+    """:param not_before: Refresh a snapshot taken before this time, whatever its age,
+        and raise StaleSnapshotError if qstat fails so that only such a snapshot is left
+    """
+    global _parsed_snapshot
+    xml_, taken_at = get_qstat_xml(ttl)
+    if not_before is not None and taken_at < not_before:
+        xml_, taken_at = get_qstat_xml(0)
+        if taken_at < not_before:  # it can't list jobs submitted since
+            raise StaleSnapshotError(f"qstat failed and the last snapshot predates {not_before}")
 
-    dd = etree_to_dict(e)
-    job_list = get_job_list(dd)
+    if _parsed_snapshot[0] != taken_at:  # only parse each snapshot once
+        _parsed_snapshot = (taken_at, parse_job_list(xml_))
 
-    return job_list
+    return _parsed_snapshot[1]
 
-def get_job_lines():
-    job_list = get_job_list_direct()
+def get_job_rows(job_list=None, aggregate=True, psub_statuses: PsubStatuses = None) -> list:
+    if job_list is None:
+        job_list = get_job_list_direct()
+    if not aggregate:
+        return job_list
+    return summarize_jobs(job_list, Psub.get_history_index(), psub_statuses)
+
+
+def get_job_lines(rows=None, now: datetime = None):
+    if rows is None:
+        rows = get_job_rows()
     line_width, term_height = shutil.get_terminal_size((80, 20))
+    now = now or datetime.now()
 
-    lines = [j.one_line_rep(line_width) for j in job_list]
+    lines = [row.one_line_rep(line_width, now=now) for row in rows]
     return lines
 
 
 def get_cpu_utilization_of_interactive_nodes():
     cpu_usages_d = {}
-    job_list = get_job_list_direct()
-    for job in job_list:
-        if job.JB_name == 'QRLOGIN':
-            node_name = job.queue_name.split('@')[-1]
-            pp = Path(__file__).parents[0].absolute()
-
-            cmd_ = f"ssh {node_name} -f 'python {pp}/sge_check_cpu_util.py'"
-            cp = subprocess.run(cmd_, shell=True, capture_output=True)
-            cpu_usage = cp.stdout.decode('utf-8').strip()
-            cpu_usages_d[node_name] = cpu_usage
-            print(f"{node_name}: {cpu_usage}")
+    for result in probe_interactive_nodes(get_job_list_direct()):
+        cpu_usage = result.cpu_usage if result.error is None else ''
+        cpu_usages_d[result.node] = cpu_usage
+        print(f"{result.node}: {cpu_usage or result.error}")
 
     return cpu_usages_d
 
 
-def main():
+class ScreenRenderer:
+    """Rewrites only the terminal lines that differ from the previous frame."""
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.prev_lines: List[str] = []
+
+    def reset(self):
+        self.prev_lines = []
+        self.out.write(AnsiCommands.CLEAR_SCREEN)
+
+    def render(self, lines: List[str]):
+        buf = []
+        for row, line in enumerate(lines):
+            if row < len(self.prev_lines) and self.prev_lines[row] == line:
+                continue
+            buf.append(f"\033[{row + 1};1H{line}\033[K")
+        for row in range(len(lines), len(self.prev_lines)):
+            buf.append(f"\033[{row + 1};1H\033[K")
+
+        if buf:
+            self.out.write(''.join(buf))
+            self.out.flush()
+        self.prev_lines = list(lines)
+
+
+def fit_to_screen(lines: List[str], term_height: int) -> List[str]:
+    if len(lines) < term_height:
+        return lines
+    # does not fit screen
+    return [f'↑ More jobs: {len(lines) - term_height} ↑'] + lines[-term_height + 2:]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sge_monitor", description="Monitor jobs on SGE.")
+    parser.add_argument("--poll", type=float, default=DEFAULT_TTL,
+                        help="Seconds between qstat queries.")
+    parser.add_argument("--redraw", type=float, default=1.0,
+                        help="Seconds between screen updates.")
+    parser.add_argument("--per-task", action="store_true",
+                        help="Show every array task on its own line.")
+    parser.add_argument("--status-interval", type=float, default=DEFAULT_STATUS_INTERVAL,
+                        help="Seconds between updates of each job's psub status.")
+    args = parser.parse_args(argv)
+
+    renderer = ScreenRenderer()
+    psub_statuses = PsubStatuses(args.status_interval)
+    terminal_size = None
+    rows = []
+    last_poll = -float("inf")
+
     try:
         sys.stdout.write(AnsiCommands.SWITCH_ALT_SCREEN)
         while True:
-            line_width, term_height = shutil.get_terminal_size((80, 20))
-            lines = get_job_lines()
-            num_blank_lines = term_height - len(lines) - 1
-
-            if num_blank_lines > 0:
-                lines += [''] * num_blank_lines
-            else:  # does not fit screen
-                lines = [f'↑ More jobs: {len(lines) - term_height} ↑'] + \
-                        lines[-term_height+2:]
-
-            sys.stdout.write(AnsiCommands.CLEAR_SCREEN)
-            sys.stdout.flush()
-
-            for line in lines:
-                print(line)
+            if time.monotonic() - last_poll >= args.poll:
+                rows = get_job_rows(get_job_list_direct(ttl=args.poll),
+                                    aggregate=not args.per_task, psub_statuses=psub_statuses)
+                last_poll = time.monotonic()
 
-            GO_UP = f"\u001b[{term_height - 1}A"
-            GO_LEFT = u"\u001b[1000D"
+            if shutil.get_terminal_size((80, 20)) != terminal_size:
+                terminal_size = shutil.get_terminal_size((80, 20))
+                renderer.reset()
 
-            sys.stdout.write(GO_LEFT)
-            sys.stdout.write(GO_UP)
+            line_width, term_height = terminal_size
+            lines = fit_to_screen(get_job_lines(rows), term_height)
+            renderer.render(lines)
 
-            time.sleep(1)
+            time.sleep(args.redraw)
 
     except KeyboardInterrupt:
         pass
     finally:
         sys.stdout.flush()
         sys.stdout.write(AnsiCommands.SWITCH_NORMAL_SCREEN)
+        psub_statuses.close(wait=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+"""Follow the commands of a submitted job as they finish.
+
+``StatusWatcher`` re-reads the exit status ledgers through an incremental
+``StatusCache``, so each check only reads what was appended since the last
+one. Between checks it blocks on inotify events for the ``exit_status``
+directory when the kernel supports it, and otherwise sleeps. Writes made by
+other hosts on a network filesystem do not raise inotify events, so the wait
+is always bounded by the poll interval, which grows by ``backoff`` while
+nothing changes and drops back once something does. When a wait brings
+nothing new and the scheduler no longer lists the job, because it was
+deleted or its tasks died, the remaining commands will never end and the
+watch stops.
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import time
+from typing import AsyncIterator, Iterator, List, NamedTuple, Optional
+
+from psub.exit_status import StatusCache, ENDED, POLLING_SAVE_INTERVAL
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_MAX_INTERVAL = 30.0
+DEFAULT_BACKOFF = 1.5
+
+
+class TaskEvent(NamedTuple):
+    line: int  # in the commands file, from 1
+    command: str
+    exit_code: int
+    host: str
+    timestamp: int
+
+    @property
+    def success(self) -> bool:
+        return self.exit_code == 0
+
+
+class Inotify:
+    """Minimal inotify(7) binding, watching one directory."""
+
+    def __init__(self, path: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {path}")
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def wait(self, timeout: float) -> bool:
+        """:return: Whether there were events before ``timeout`` seconds"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        self.drain()
+        return bool(readable)
+
+    def drain(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class StatusWatcher:
+    """Completion events of one job's commands, until all of them have ended
+    or the job has left the scheduler's queue.
+
+    :param include_finished: Also yield commands that had already ended
+    :param timeout: Seconds after which to give up with ``TimeoutError``
+    """
+
+    def __init__(self, p, include_finished: bool = True, timeout: float = None,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 max_interval: float = DEFAULT_MAX_INTERVAL,
+                 backoff: float = DEFAULT_BACKOFF, use_inotify: bool = True):
+        self.p = p
+        self.exit_status_dir = f"{p.tmp_dir}/exit_status"
+        self.include_finished = include_finished
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_interval = max(max_interval, poll_interval)
+        self.backoff = backoff
+        self.use_inotify = use_inotify
+
+        self.status_cache = StatusCache(self.exit_status_dir, save_interval=POLLING_SAVE_INTERVAL)
+        self.status_cache.track_new = True
+
+    def _events(self) -> List[TaskEvent]:
+        self.status_cache.refresh()
+        return [
+            TaskEvent(r.line, self.p._display_command(r.line - 1), r.exit_code, r.host, r.timestamp)
+            for r in self.status_cache.pop_new_records() if r.state == ENDED
+        ]
+
+    def done(self) -> bool:
+        return self.p._all_ended(self.status_cache.counts)
+
+    def _open_inotify(self) -> Optional[Inotify]:
+        if not self.use_inotify:
+            return None
+        try:
+            return Inotify(self.exit_status_dir)
+        except (OSError, AttributeError) as e:  # not Linux, or the directory is not there yet
+            logging.debug(f"Polling {self.exit_status_dir} without inotify: {e}")
+            return None
+
+    def _first_events(self) -> List[TaskEvent]:
+        events = self._events()
+        return events if self.include_finished else []
+
+    def _next_interval(self, interval: float, changed: bool) -> float:
+        return self.poll_interval if changed else min(interval * self.backoff, self.max_interval)
+
+    def _remaining(self, deadline: Optional[float], interval: float) -> float:
+        if deadline is None:
+            return interval
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"{self.p.name} still running after {self.timeout} s")
+        return min(interval, remaining)
+
+    def __iter__(self) -> Iterator[TaskEvent]:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        inotify = self._open_inotify()
+        try:
+            yield from self._first_events()
+            interval = self.poll_interval
+            while not self.done():
+                wait_s = self._remaining(deadline, interval)
+                if inotify is not None:
+                    inotify.wait(wait_s)
+                else:
+                    time.sleep(wait_s)
+                events = self._events()
+                yield from events
+                if not events and self.p._left_queue():
+                    yield from self._events()  # written just before it left
+                    return
+                interval = self._next_interval(interval, bool(events))
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    async def __aiter__(self) -> AsyncIterator[TaskEvent]:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        inotify = self._open_inotify()
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+        if inotify is not None:
+            loop.add_reader(inotify.fileno(), woken.set)
+        try:
+            for event in self._first_events():
+                yield event
+            interval = self.poll_interval
+            while not self.done():
+                wait_s = self._remaining(deadline, interval)
+                try:
+                    await asyncio.wait_for(woken.wait(), wait_s)
+                except asyncio.TimeoutError:
+                    pass
+                woken.clear()
+                if inotify is not None:
+                    inotify.drain()
+                events = self._events()
+                for event in events:
+                    yield event
+                if not events and self.p._left_queue():
+                    for event in self._events():  # written just before it left
+                        yield event
+                    return
+                interval = self._next_interval(interval, bool(events))
+        finally:
+            if inotify is not None:
+                loop.remove_reader(inotify.fileno())
+                inotify.close()
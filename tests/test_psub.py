@@ -1,3 +1,7 @@
+import json
+import os
+import re
+
 import pytest
 
 from psub import Psub
@@ -43,3 +47,794 @@ def test_parse_psub_command_string_to_command_list(p, expected_commands):
 def test_cli():
     import os
     os.system('psub echo {} -k {} -q {} ::: arg1 arg2 ::: argA argB argC ::: argX argY')
+
+
+@pytest.fixture()
+def psub_dirs(tmp_path, monkeypatch):
+    import psub.main
+    monkeypatch.setattr(psub.main, "PATH_PSUB", f"{tmp_path}/.psub")
+    monkeypatch.setattr(psub.main, "TMP_DIR", f"{tmp_path}/psub_tmp")
+    monkeypatch.setattr(psub.main, "HISTORY_DIR", f"{tmp_path}/.psub/history")
+    return tmp_path
+
+
+def test_commands_file_index(tmp_path):
+    from psub.commands_file import write_commands_file, read_commands, iter_commands
+
+    commands_fn = f"{tmp_path}/job.commands.sh"
+    commands = [f"echo {i} ünïcode" for i in range(1, 25001)]
+    num_commands, sha256 = write_commands_file(commands, commands_fn)
+    assert num_commands == len(commands)
+
+    assert read_commands(commands_fn, 1) == [commands[0]]
+    assert read_commands(commands_fn, 12345, 3) == commands[12344:12347]
+    assert read_commands(commands_fn, 24999, 10) == commands[-2:]
+    assert read_commands(commands_fn, 25001) == []
+
+    assert list(iter_commands(commands_fn)) == commands  # over several read blocks
+    assert list(iter_commands(commands_fn, 9999, 10003)) == commands[9998:20001]
+
+
+def test_run_task_reads_batch_from_index(psub_dirs, p):
+    import subprocess
+
+    p.add([f"echo line {i} > {psub_dirs}/out.{i}" for i in range(1, 8)])
+    p._prepare_submit_files()
+
+    subprocess.run(
+        ["bash", p.task_runner_fn, p.commands_list_fn, "3", p.tmp_dir],
+        env={"SGE_TASK_ID": "4", "PATH": "/usr/bin:/bin"},
+        check=True,
+    )
+
+    assert sorted(p._get_exit_codes()) == [4, 5, 6]
+    assert open(f"{psub_dirs}/out.6").read() == "line 6\n"
+
+
+def test_exit_status_ledger_and_legacy_files(psub_dirs, p):
+    from psub.exit_status import format_record, RECORD_SIZE
+
+    exit_status_dir = f"{p.tmp_dir}/exit_status"
+    os.makedirs(exit_status_dir)
+    assert len(format_record(1, "S", 1600000000, -1, "n" * 40)) == RECORD_SIZE
+
+    with open(f"{exit_status_dir}/ledger.n1", "wb") as f:
+        f.write(format_record(1, "S", 100, -1, "n1"))
+        f.write(format_record(1, "E", 100, 0, "n1"))
+        f.write(format_record(2, "S", 101, -1, "n1"))
+        f.write(format_record(3, "S", 101, -1, "n1")[:10])  # partial append
+    with open(f"{exit_status_dir}/ledger.n2", "wb") as f:
+        f.write(format_record(2, "E", 105, 3, "n2"))
+    with open(f"{exit_status_dir}/4", "w") as f:
+        print("started 100", file=f)  # written by an older run_task.sh
+
+    assert p._get_exit_codes() == {1: "0", 2: "3", 4: "started"}
+
+
+def test_status_cache_reads_incrementally(psub_dirs, p):
+    from psub.exit_status import format_record
+
+    p.add(["true 1", "true 2", "false"])
+    exit_status_dir = f"{p.tmp_dir}/exit_status"
+    os.makedirs(exit_status_dir)
+    assert p.status == "Not yet started"
+
+    ledger_fn = f"{exit_status_dir}/ledger.n1"
+    with open(ledger_fn, "ab") as f:
+        f.write(format_record(1, "S", 100, -1, "n1"))
+        f.write(format_record(1, "E", 101, 0, "n1"))
+        f.write(format_record(2, "S", 101, -1, "n1"))
+    assert p.status == "Running [33%]"
+
+    with open(ledger_fn, "ab") as f:
+        f.write(format_record(2, "E", 102, 0, "n1"))
+        f.write(format_record(3, "E", 102, 1, "n1"))
+    assert p.status == "Errors [33%]"
+    assert not p.success
+    assert list(p.exit_codes.values()) == [
+        "Success", "Success", "Terminated with nonzero status"]
+
+    # a fresh object picks up from the persisted cache instead of re-reading
+    os.remove(ledger_fn)
+    p2 = Psub.loads(p.dumps())
+    assert p2._get_exit_codes() == {1: "0", 2: "0", 3: "1"}
+
+
+def test_command_grid_is_lazy(p, expected_commands):
+    from psub.commands import CommandGrid
+
+    grid = CommandGrid("echo {} -k {} -q {}", [["arg1", "arg2"], ["argA", "argB", "argC"], ["argX", "argY"]])
+    assert len(grid) == 12
+    assert list(grid) == expected_commands
+    assert [grid[i] for i in range(-12, 12)] == expected_commands * 2
+
+    big = [[str(i) for i in range(1000)]] * 3
+    p.add("echo first")
+    p.add_parameter_combinations("echo {} {} {}", *big)
+    assert p.num_commands == 1 + 1000 ** 3
+    assert p._command_at(1 + 1000 ** 3 - 1) == "echo 999 999 999"
+    assert "echo 0 0 3\n...\necho 999 999 995" in str(p)
+
+
+def test_history_record_is_compact(psub_dirs, p):
+    import json
+    import psub.main
+
+    explicit = [f"echo {i}" for i in range(psub.main.INLINE_COMMANDS_MAX + 1)]
+    p.add(explicit)
+    p.add_parameter_combinations("echo {} {}", ["a", "b"], ["c", "d"])
+    p._prepare_submit_files()
+
+    d = json.loads(p.dumps())
+    assert "commands" not in d
+    assert d["command_sources"][0]["commands_file"] == p.commands_list_fn
+    assert d["command_sources"][1] == {"template": "echo {} {}", "parameters": [["a", "b"], ["c", "d"]]}
+
+    p2 = Psub.loads(p.dumps())
+    assert p2.num_commands == len(explicit) + 4
+    assert p2._command_at(500) == "echo 500"
+    assert p2.commands == p.commands
+
+    from psub.commands import CommandsFileChanged
+    with open(p.commands_list_fn, "a") as f:  # another job reused the name and path
+        print("echo other", file=f)
+    p3 = Psub.loads(p.dumps())
+    with pytest.raises(CommandsFileChanged):
+        p3._command_at(500)
+    assert p3._display_command(0) == f"<{p.commands_list_fn} unavailable>"
+
+
+def test_migrate_legacy_history_record(psub_dirs, p, expected_commands):
+    import json
+    import psub.main
+
+    p.add(expected_commands)
+    p.submit_time = "2021-01-01T00:00:00"
+    legacy_d = {k: v for k, v in p.__dict__.items() if not k.startswith("_")}
+    legacy_d["commands"] = expected_commands
+    os.makedirs(psub.main.HISTORY_DIR)
+    legacy_fn = f"{psub.main.HISTORY_DIR}/{p.submit_time}.{p.name}.json"
+    with open(legacy_fn, "w") as f:
+        json.dump(legacy_d, f, indent=2)
+
+    assert Psub.load(legacy_fn).commands == expected_commands
+    assert Psub.migrate_history() == 1
+    assert Psub.migrate_history() == 0
+    assert "command_sources" in json.load(open(legacy_fn))
+    assert Psub.load(legacy_fn).commands == expected_commands
+
+
+def test_history_index(psub_dirs, p):
+    import psub.main
+
+    os.makedirs(psub.main.HISTORY_DIR)
+
+    p.add(["echo 1", "echo 2"])
+    p.submit_time = "2021-01-01T00:00:00"
+    p._register_to_history()
+
+    p2 = Psub(name="later_job")
+    p2.add_parameter_combinations("echo {}", ["a", "b", "c"])
+    p2.submit_time = "2021-01-02T00:00:00"
+    with open(f"{psub.main.HISTORY_DIR}/{p2.submit_time}.{p2.name}.json", "w") as f:
+        print(p2.dumps(), file=f)  # written before the index existed
+
+    entries = Psub.get_history_index()
+    assert [e.name for e in entries] == [p2.name, p.name]
+    assert entries[1].str_single_line() == p.str_single_line()
+    assert entries[0].load().commands == ["echo a", "echo b", "echo c"]
+    assert len(Psub.get_history_index()) == 2  # backfilled only once
+
+    os.remove(entries[1].json_fn)  # deleted records leave the listing
+    assert [e.name for e in Psub.get_history_index()] == [p2.name]
+    assert len(open(f"{psub.main.HISTORY_DIR}/index.jsonl").readlines()) == 2
+
+
+def test_polled_status_cache_saves_rarely(tmp_path):
+    from psub.exit_status import format_record, StatusCache, CACHE_FN
+
+    ledger_fn = tmp_path / "ledger.n1"
+    status_cache = StatusCache(str(tmp_path), save_interval=3600)
+    for line in range(1, 4):
+        with open(ledger_fn, "ab") as f:
+            f.write(format_record(line, "E", 100 + line, 0, "n1"))
+        status_cache.refresh()
+    assert status_cache.counts["success"] == 3
+    # saved after the first change only, the next ones wait for the interval
+    assert len(json.load(open(tmp_path / CACHE_FN))["records"]) == 1
+    assert StatusCache(str(tmp_path)).refresh().counts["success"] == 3  # still consistent
+
+
+def test_status_fetcher_does_not_wait_for_slow_jobs():
+    import threading
+    from psub.cli import StatusFetcher
+
+    release = threading.Event()
+
+    class Entry:
+        def __init__(self, name, status):
+            self.name = name
+            self.status = status
+
+        def load(self):
+            if self.name == "slow":
+                release.wait()
+            return self
+
+    fetcher = StatusFetcher([Entry("slow", "Running [5%]"), Entry("fast", "Finished")], timeout=0.1)
+    assert fetcher.get(1, wait=True) == "Finished"
+    assert fetcher.get(0, wait=True) == "..."
+    release.set()
+    fetcher.shutdown()
+
+
+def test_log_preview_matches_full_read(tmp_path):
+    from psub.logs import log_preview
+
+    def full_read_preview(log_fn):
+        log_l = open(log_fn).readlines()
+        if len(log_l) > 30:
+            return ''.join(log_l[:15] + ['...\n'] + log_l[-15:])
+        return ''.join(log_l)
+
+    for num_lines in [3, 30, 31, 200000]:
+        log_fn = f"{tmp_path}/job.{num_lines}.n1.log"
+        with open(log_fn, "w") as f:
+            for i in range(num_lines):
+                print(f"line {i} " + "x" * (i % 50), file=f)
+        assert log_preview(log_fn) == full_read_preview(log_fn)
+
+    with open(log_fn, "a") as f:
+        print("appended", file=f)
+    assert log_preview(log_fn).endswith("appended\n")  # cache sees the new size
+
+
+def test_log_search_index_is_incremental(tmp_path):
+    from psub.logs import LogSearchIndex
+
+    for task_id in range(1, 201):
+        with open(f"{tmp_path}/job.{task_id}.n1.log", "w") as f:
+            print(f"task {task_id} running", file=f)
+
+    search_index = LogSearchIndex(str(tmp_path))
+    assert search_index.update() == 200
+    assert search_index.search("Segmentation fault") == []
+
+    with open(f"{tmp_path}/job.17.n1.log", "a") as f:
+        print("Segmentation fault (core dumped)", file=f)
+
+    search_index = LogSearchIndex(str(tmp_path))  # reloaded from disk
+    assert search_index.update() == 1
+    assert search_index.search("Segmentation fault") == [
+        (f"{tmp_path}/job.17.n1.log", 2, "Segmentation fault (core dumped)")
+    ]
+    assert len(search_index.search("running")) == 200
+
+
+def test_log_search_index_survives_truncated_logs(tmp_path, monkeypatch):
+    import psub.logs
+    from psub.logs import LogSearchIndex
+
+    log_fn = tmp_path / "job.1.n1.log"
+    log_fn.write_text("retried\n")
+
+    class ShrunkEntry:  # stat'ed before a rerun truncated it
+        name = log_fn.name
+        path = str(log_fn)
+
+        def stat(self):
+            return os.stat_result((0,) * 6 + (10 ** 6,) + (0,) * 3)
+
+    monkeypatch.setattr(psub.logs.os, "scandir", lambda _: [ShrunkEntry()])
+    search_index = LogSearchIndex(str(tmp_path))
+    assert search_index.update() == 1
+    assert search_index.files[log_fn.name][0] == len("retried\n")
+    monkeypatch.undo()
+    assert search_index.search("retried") == [(str(log_fn), 1, "retried")]
+
+
+def test_packed_task_runs_batch_concurrently(psub_dirs):
+    import subprocess
+    import time
+
+    p = Psub(name="packed", num_cores=4, batch_size=4, pack=True)
+    p.add([f"sleep 1; echo out {i}; exit {i % 2}" for i in range(1, 6)])
+    p._prepare_submit_files()
+    assert "-o " + f"{p.log_dir}/task." in open(p.submission_script_fn).read()
+
+    start = time.monotonic()
+    subprocess.run(
+        ["bash", p.task_runner_fn, p.commands_list_fn, "4", p.tmp_dir, str(p.num_workers), p.log_dir],
+        env={"SGE_TASK_ID": "1", "HOSTNAME": "n1", "PATH": "/usr/bin:/bin"},
+        check=True,
+    )
+    assert time.monotonic() - start < 3
+
+    assert p._get_exit_codes() == {1: "1", 2: "0", 3: "1", 4: "0"}
+    for i in range(1, 5):
+        assert open(f"{p.log_dir}/job.{i}.n1.log").read() == f"out {i}\n"
+
+
+def test_choose_batch_size_from_previous_runs(psub_dirs):
+    import psub.main
+    from psub.exit_status import format_record
+
+    os.makedirs(psub.main.HISTORY_DIR)
+    previous = Psub(name="sweep")
+    previous.add_parameter_combinations("./run.sh {}", [str(i) for i in range(100)])
+    previous.submit_time = "2021-01-01T00:00:00"
+    previous._register_to_history()
+    os.makedirs(f"{previous.tmp_dir}/exit_status")
+    with open(f"{previous.tmp_dir}/exit_status/ledger.n1", "wb") as f:
+        for line in range(1, 101):
+            f.write(format_record(line, "S", 1000 + line * 60, -1, "n1"))
+            f.write(format_record(line, "E", 1000 + line * 60 + 60, 0, "n1"))
+
+    p = Psub(name="sweep")
+    p.add_parameter_combinations("./run.sh {}", [str(i) for i in range(1000)])
+    assert p.choose_batch_size("0:30:00")
+    assert p.batch_size == 30
+    assert p.l_time == "0:45:00"
+    assert "60.0 s on average" in str(p)
+
+    p_other = Psub(name="other")
+    p_other.add("./other.sh")
+    assert not p_other.choose_batch_size("0:30:00")
+    assert p_other.batch_size == 1
+
+
+FAKE_QSUB = r"""#!/bin/bash
+# Runs the array tasks of a submitted script locally and concurrently, like qsub would on a cluster
+exec 9> "$FAKE_QSUB_DIR/.lock"
+flock 9  # job IDs are handed out in order, also to concurrent calls
+JOB_ID=$(( $(ls "$FAKE_QSUB_DIR" | grep -c '^submitted') + 1 ))
+SCRIPT=$FAKE_QSUB_DIR/submitted.$JOB_ID.sh
+echo "$@" > "$FAKE_QSUB_DIR/args.$JOB_ID"
+sed '/^sleep [0-9-]* 2> \/dev\/null$/d' > "$SCRIPT"  # no need to outlast the scheduler's polling
+flock -u 9
+if [ -e "$FAKE_QSUB_DIR/queue_only" ]; then  # leave the tasks waiting
+    echo "Your job-array $JOB_ID.1-1:1 (\"$(basename "$SCRIPT")\") has been submitted"
+    exit
+fi
+RANGE=$(sed -n 's/^#\$ -t //p' "$SCRIPT")
+RANGE=${RANGE:-1-1}
+FIRST=${RANGE%%-*}
+REST=${RANGE#*-}
+LAST=${REST%%:*}
+STEP=1
+[[ $REST == *:* ]] && STEP=${REST#*:}
+LOG=$(sed -n 's/^#\$ -o //p' "$SCRIPT")
+for (( T=FIRST; T<=LAST; T+=STEP )); do
+    SGE_TASK_ID=$T JOB_ID=$JOB_ID bash "$SCRIPT" > "${LOG//\$TASK_ID/$T}" 2>&1 &
+done
+wait
+echo "Your job-array $JOB_ID.$FIRST-$LAST:$STEP (\"$(basename "$SCRIPT")\") has been submitted"
+"""
+
+
+@pytest.fixture()
+def fake_qsub(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "qsub").write_text(FAKE_QSUB)
+    (bin_dir / "qsub").chmod(0o755)
+    qsub_dir = tmp_path / "qsub"
+    qsub_dir.mkdir()
+    # qstat lists whatever a test puts in qstat.xml
+    (bin_dir / "qstat").write_text(f"#!/bin/bash\ncat {qsub_dir}/qstat.xml 2> /dev/null || echo '<job_info/>'\n")
+    (bin_dir / "qstat").chmod(0o755)
+    # and refuses the job IDs in qalter_gone, as for a job that finished meanwhile
+    (bin_dir / "qalter").write_text(
+        f"#!/bin/bash\necho \"$@\" >> {qsub_dir}/qalter_calls\n"
+        f"! grep -qx \"${{@: -1}}\" {qsub_dir}/qalter_gone 2> /dev/null\n")
+    (bin_dir / "qalter").chmod(0o755)
+    import psub.utilities.qstat_snapshot as qstat_snapshot
+    monkeypatch.setattr(qstat_snapshot, "SNAPSHOT_FN", f"{tmp_path}/qstat_snapshot.xml")
+    monkeypatch.setenv("FAKE_QSUB_DIR", str(qsub_dir))
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    return qsub_dir
+
+
+def test_queue_workers_drain_queue_and_retry(psub_dirs, fake_qsub):
+    p = Psub(name="queued", batch_size=2, queue_workers=3, max_attempts=2)
+    # odd lines fail on their first run only
+    p.add([f"echo out {i}; [ $(({i} % 2)) = 0 ] || [ -e {psub_dirs}/ran.{i} ] "
+           f"|| {{ touch {psub_dirs}/ran.{i}; exit 1; }}" for i in range(1, 12)])
+    p.submit(skip_confirm=True)
+
+    script = open(next(fake_qsub.glob("submitted.*.sh"))).read()
+    assert "#$ -t 1-3\n" in script
+    assert p.status == "Finished"
+    assert all(os.path.exists(f"{psub_dirs}/ran.{i}") for i in range(1, 12, 2))
+    assert os.listdir(f"{p.queue_dir}/pending") == []
+    assert os.listdir(f"{p.queue_dir}/claimed") == []
+    assert open(f"{p.queue_dir}/cursor").read() == "12 11\n"
+    for i in range(1, 12):
+        log_fns = [fn for fn in os.listdir(p.log_dir) if fn.startswith(f"job.{i}.")]
+        assert [open(f"{p.log_dir}/{fn}").read() for fn in log_fns] == [f"out {i}\n"]
+
+
+def test_local_backend(psub_dirs):
+    from psub.backends import Backend
+    from psub.logs import task_id_from_log_fn
+
+    with pytest.raises(TypeError):  # backends must implement submit
+        type("NoSubmit", (Backend,), {"name": "none"})()
+
+    from psub.backends import LocalBackend
+
+    # one worker, so later commands wait for earlier ones to finish before they are queued
+    p = Psub(name="local", backend=LocalBackend(max_workers=1))
+    p.add([f"echo out {i}; exit {int(i == 3)}" for i in range(1, 6)])
+    p.submit(skip_confirm=True)
+
+    assert p.status == "Errors [20%]"
+    assert list(p.exit_codes.values()).count("Terminated with nonzero status") == 1
+    log_fns = sorted(os.listdir(p.log_dir), key=task_id_from_log_fn)
+    assert [open(f"{p.log_dir}/{fn}").read() for fn in log_fns] == [f"out {i}\n" for i in range(1, 6)]
+
+    entry = Psub.get_history_index()[0]
+    assert entry.load().backend == "local"
+    assert entry.load()._get_backend().name == "local"
+
+
+def test_skip_done_and_rerun_failed(psub_dirs):
+    input_fn = psub_dirs / "params.txt"
+    input_fn.write_text("a\n")
+    commands = [f"echo {i}; exit {int(i % 3 == 0)}" for i in range(1, 10)]
+
+    p = Psub(name="sweep", backend="local", input_files=[str(input_fn)])
+    p.add(commands + ["echo same", "echo same"])
+    p.submit(skip_confirm=True)
+
+    p_again = Psub(name="sweep", input_files=[str(input_fn)])
+    p_again.add(commands + ["echo same", "echo new"])
+    assert p_again.skip_done() == 7
+    assert p_again.commands == [c for c in commands if "exit 1" in c] + ["echo new"]
+
+    # changing an input invalidates earlier successes
+    os.utime(input_fn, ns=(0, 0))
+    p_changed = Psub(name="sweep", input_files=[str(input_fn)])
+    p_changed.add(commands)
+    assert p_changed.skip_done() == 0
+
+    p.rerun_failed()
+    rerun, = [e.load() for e in Psub.get_history_index() if e.name.startswith("sweep_rerun.")]
+    assert rerun.tmp_dir != p.tmp_dir
+    assert rerun.commands == [c for c in commands if "exit 1" in c]
+
+
+@pytest.mark.parametrize("backend", ["sge", "local"])
+def test_resource_usage_is_recorded(psub_dirs, fake_qsub, backend):
+    p = Psub(name="usage", backend=backend)
+    p.add(["python -c 'b = bytearray(64 * 2**20); sum(range(10**6))'", "sleep 0.3", "exit 1"])
+    p.submit(skip_confirm=True)
+
+    assert p.status == "Errors [33%]"
+    usage = p.resource_usage()
+    assert usage["max_rss_mb"]["max"] > 64
+    assert 0.3 <= usage["wall_seconds"]["max"] < 5
+    assert usage["cpu_seconds"]["p50"] < 0.3
+    assert "Resource usage of 3 commands" in p.resource_usage_table()
+
+
+def test_exit_codes_without_waitstatus_to_exitcode(psub_dirs, fake_qsub, monkeypatch):
+    """Python 3.7 and 3.8 lack os.waitstatus_to_exitcode, and nodes may lack GNU time."""
+    from psub.backends import run_command
+
+    site_dir = psub_dirs / "site"
+    site_dir.mkdir()
+    # subprocess binds it when imported on 3.9+, so only hide it from code that runs later
+    (site_dir / "sitecustomize.py").write_text(
+        "import os\nimport subprocess\ndel os.waitstatus_to_exitcode\n")
+    monkeypatch.setenv("PYTHONPATH", str(site_dir))  # for the time_command.py shim
+    monkeypatch.setenv("PSUB_NO_GNU_TIME", "1")
+
+    commands = ["echo hi", "exit 3", "kill -TERM $$"]
+    p = Psub(name="old_python")
+    p.add(commands)
+    p.submit(skip_confirm=True)
+    assert p._get_exit_codes() == {1: "0", 2: "3", 3: "143"}
+    assert len(read_usage_lines(p)) == 3
+
+    # what the local backend runs in each pool worker
+    local = Psub(name="old_python_local")
+    local.add(commands)
+    local._prepare_submit_files()
+    with monkeypatch.context() as m:
+        m.delattr(os, "waitstatus_to_exitcode", raising=False)
+        for line, command in enumerate(commands, start=1):
+            run_command(line, command, f"{local.tmp_dir}/exit_status", local.log_dir)
+    assert local._get_exit_codes() == {1: "0", 2: "3", 3: "143"}
+    assert len(read_usage_lines(local)) == 3
+
+
+def read_usage_lines(p):
+    from psub.exit_status import read_usage
+    return read_usage(f"{p.tmp_dir}/exit_status")
+
+
+def _start_run_task(p, num_commands):
+    import subprocess
+
+    return subprocess.Popen(
+        ["bash", p.task_runner_fn, p.commands_list_fn, str(num_commands), p.tmp_dir, "1", p.log_dir],
+        env={"SGE_TASK_ID": "1", "HOSTNAME": "n1", "PATH": os.environ["PATH"]},
+    )
+
+
+def test_watch_yields_each_finished_command(psub_dirs, p):
+    import time
+    from psub.watch import StatusWatcher
+
+    p.add([f"sleep 0.2; exit {i % 2}" for i in range(1, 6)])
+    p._prepare_submit_files()
+    proc = _start_run_task(p, 5)
+
+    # a long poll interval, so only inotify can keep up
+    start = time.monotonic()
+    events = list(p.watch(poll_interval=30, timeout=20))
+    assert time.monotonic() - start < 10
+    assert [e.line for e in events] == [1, 2, 3, 4, 5]
+    assert [e.success for e in events] == [False, True, False, True, False]
+    assert events[1].command == "sleep 0.2; exit 0"
+    proc.wait()
+
+    # already finished, polling only
+    watcher = StatusWatcher(p, poll_interval=0.05, use_inotify=False)
+    assert len(list(watcher)) == 5
+    assert list(p.watch(include_finished=False)) == []
+    assert not p.wait()
+
+
+def test_wait_async_and_timeout(psub_dirs, p):
+    import asyncio
+
+    p.add(["sleep 0.2", "sleep 0.2"])
+    p._prepare_submit_files()
+
+    with pytest.raises(TimeoutError):
+        p.wait(timeout=0.2, poll_interval=0.05)
+
+    proc = _start_run_task(p, 2)
+    assert asyncio.run(p.wait_async(timeout=20, poll_interval=30))
+    proc.wait()
+
+
+def test_wait_stops_once_job_leaves_queue(psub_dirs, fake_qsub, monkeypatch):
+    import psub.utilities.qstat_snapshot
+
+    (fake_qsub / "queue_only").touch()
+    p = Psub(name="killed")
+    p.add(["echo a", "echo b"])
+    p.submit(skip_confirm=True)
+    # no snapshot is reused, so every check sees qstat.xml
+    monkeypatch.setattr(psub.utilities.qstat_snapshot, "DEFAULT_TTL", 0)
+
+    (fake_qsub / "qstat.xml").write_text(
+        QSTAT_JOB_XML.format(job_id=1, job_name=f"{p.name}.commands.sh", state="r"))
+    with pytest.raises(TimeoutError):
+        p.wait(timeout=0.3, poll_interval=0.05)
+
+    # qdel'd, or its tasks died, after the first command
+    from psub.exit_status import format_record
+    with open(f"{p.tmp_dir}/exit_status/ledger.n1", "wb") as f:
+        f.write(format_record(1, "S", 100, -1, "n1"))
+        f.write(format_record(1, "E", 101, 0, "n1"))
+    (fake_qsub / "qstat.xml").write_text("<job_info/>")
+    assert [e.line for e in p.watch(timeout=20, poll_interval=0.05)] == [1]
+    assert not p.wait(timeout=20, poll_interval=0.05)
+
+
+def test_submit_after_holds_for_other_job(psub_dirs, fake_qsub):
+    from psub.backends import parse_job_id
+
+    assert parse_job_id('Your job 4242 ("x") has been submitted') == 4242
+    assert parse_job_id('Your job-array 17.1-9:3 ("x") has been submitted') == 17
+
+    first = Psub(name="stage1", batch_size=2)
+    first.add(["echo a", "echo b", "exit 1"])  # not a success, so later stages still hold
+    first.submit(skip_confirm=True)
+    assert first.job_ids == [1]
+    assert Psub.get_history_index()[0].job_ids == [1]
+    assert Psub.get_history_index()[0].load().job_ids == [1]
+
+    same_layout = Psub(name="stage2", batch_size=2)
+    same_layout.add(["echo c", "echo d", "echo e"])
+    same_layout.submit(skip_confirm=True, after=first)
+    assert "#$ -hold_jid_ad 1\n" in open(f"{fake_qsub}/submitted.2.sh").read()
+
+    other_layout = Psub(name="stage3")
+    other_layout.add("echo f")
+    other_layout.submit(skip_confirm=True, after=[first, same_layout])
+    assert "#$ -hold_jid 1\n" in open(f"{fake_qsub}/submitted.3.sh").read()
+    with pytest.raises(ValueError):
+        other_layout.submit(skip_confirm=True, after=first, per_task=True)
+
+
+QSTAT_JOB_XML = """<?xml version='1.0'?>
+<job_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>{job_id}</JB_job_number>
+      <JB_name>{job_name}</JB_name>
+      <state>{state}</state>
+      <tasks>1-2:1</tasks>
+    </job_list>
+  </job_info>
+</job_info>
+"""
+
+
+def test_rerun_gets_its_own_job_ids(psub_dirs, fake_qsub):
+    (fake_qsub / "queue_only").touch()
+    first = Psub(name="first")
+    first.add("echo a")
+    first.submit(skip_confirm=True)
+    (fake_qsub / "queue_only").unlink()
+    p = Psub(name="flaky")
+    p.add(["echo a", "exit 1"])
+    p.submit(skip_confirm=True, after=first)
+    assert p.job_ids == [2] and p.hold_job_ids == [1]
+
+    p.rerun_failed()
+    rerun, = [e for e in Psub.get_history_index() if e.name.startswith("flaky_rerun.")]
+    assert rerun.job_ids == [3]
+    assert rerun.load().hold_job_ids == []
+    assert p.job_ids == [2]
+
+    p.submit(skip_confirm=True)
+    assert p.job_ids == [4]
+
+
+def test_status_asks_scheduler_about_job_ids(psub_dirs, fake_qsub, monkeypatch):
+    import psub.utilities.qstat_snapshot
+
+    (fake_qsub / "queue_only").touch()
+    p = Psub(name="waiting")
+    p.add(["echo a", "echo b"])
+    p.submit(skip_confirm=True)
+    assert p.job_ids == [1]
+    assert f"#$ -N {p.name}.commands.sh\n" in open(f"{fake_qsub}/submitted.1.sh").read()
+
+    # no snapshot is reused, so every check sees qstat.xml
+    monkeypatch.setattr(psub.utilities.qstat_snapshot, "DEFAULT_TTL", 0)
+    for state, status in [("qw", "Queued"), ("hqw", "Held"), ("Eqw", "Queue error")]:
+        (fake_qsub / "qstat.xml").write_text(
+            QSTAT_JOB_XML.format(job_id=1, job_name=f"{p.name}.commands.sh", state=state))
+        assert p.status == status
+
+    (fake_qsub / "qstat.xml").write_text("<job_info/>")
+    assert p.status == "Not started, no longer queued"
+
+    from psub.exit_status import format_record
+    with open(f"{p.tmp_dir}/exit_status/ledger.n1", "wb") as f:
+        f.write(format_record(1, "S", 100, -1, "n1"))
+    assert p.status == "Stopped [0%]"
+
+    no_ids = Psub(name="old")
+    no_ids.add("echo a")
+    assert no_ids.scheduler_state() is None
+    assert no_ids.status == "Not yet started"
+
+
+def test_large_arrays_are_sharded(psub_dirs, fake_qsub, capsys):
+    from psub.logs import task_id_from_log_fn
+
+    p = Psub(name="sharded", batch_size=2, shard_size=3, submit_workers=2)
+    p.add([f"echo out {i}; exit {int(i == 9)}" for i in range(1, 15)])
+    assert p._shards() == [(0, 6), (6, 6), (12, 2)]
+    p.submit(skip_confirm=True)
+
+    assert sorted(p.job_ids) == [1, 2, 3]
+    assert Psub.get_history_index()[0].job_ids == p.job_ids
+    scripts = sorted(open(fn).read() for fn in fake_qsub.glob("submitted.*.sh"))
+    assert sorted(s.count("#$ -t 1-6:2\n") for s in scripts) == [0, 1, 1]
+
+    assert p.status == f"Errors [{1 / 14:.0%}]"
+    assert [k for k, v in p.exit_codes.items() if v != "Success"] == ["echo out 9; exit 1"]
+    log_fns = sorted((fn for fn in os.listdir(p.log_dir) if fn.startswith("job.")),
+                     key=task_id_from_log_fn)
+    assert [open(f"{p.log_dir}/{fn}").read() for fn in log_fns] == [f"out {i}\n" for i in range(1, 15)]
+
+    # task_<offset>.<task id> logs are not mistaken for line <task id>
+    from psub.cli import search_logs_workflow
+    task_log_fn = next(fn for fn in os.listdir(p.log_dir) if fn.startswith("task_6."))
+    assert task_id_from_log_fn(task_log_fn) is None
+    with open(f"{p.log_dir}/{task_log_fn}", "a") as f:
+        print("out 9", file=f)
+    capsys.readouterr()
+    search_logs_workflow("out 9")
+    hits = capsys.readouterr().out.splitlines()[1:]
+    assert sorted(re.search(r"\[(\w+)\]", hit).group(1) for hit in hits) == ["1", "task"]
+
+
+def test_status_preview_colors_every_status(psub_dirs, p):
+    from psub.cli import _psub_preview_with_status, STATUS_COLORS, AnsiColors
+
+    p.add("echo a")
+    # everything Psub.get_status and StatusFetcher can return
+    statuses = ["Finished", "Errors [7%]", "Queued", "Held", "Queue error",
+                "Not started, no longer queued", "Not yet started", "Stopped [40%]",
+                "Running [40%]", "Unavailable", "..."]
+    for status in statuses:
+        preview = _psub_preview_with_status(p, status)
+        assert preview.startswith(next(col for k, col in STATUS_COLORS.items()
+                                       if status.startswith(k)) + status)
+    assert _psub_preview_with_status(p, "Something new").startswith(AnsiColors.WARNING)
+
+
+def test_throttle_waits_for_queued_retries(psub_dirs, p):
+    from psub.exit_status import format_record
+    from psub.throttle import ConcurrencyController
+
+    p.queue_workers, p.max_attempts = 2, 2
+    p.add(["echo a", "exit 1"])
+    p._prepare_submit_files()
+    with open(f"{p.tmp_dir}/exit_status/ledger.n1", "ab") as f:
+        f.write(format_record(1, "E", 100, 0, "n1"))
+        f.write(format_record(2, "E", 100, 1, "n1"))
+    open(f"{p.queue_dir}/pending/2.1.2", "w").close()  # its retry
+
+    controller = ConcurrencyController(p, max_limit=2)
+    controller.step(now=100)
+    assert not controller._job_done()
+    os.remove(f"{p.queue_dir}/pending/2.1.2")
+    assert controller._job_done()
+
+
+def test_max_concurrent_and_adaptive_throttle(psub_dirs, fake_qsub):
+    from psub.exit_status import format_record
+    from psub.throttle import ConcurrencyController
+
+    (fake_qsub / "queue_only").touch()
+    p = Psub(name="throttled", shard_size=3, max_concurrent=10)
+    p.add([f"echo {i}" for i in range(1, 61)])
+    with pytest.raises(ValueError):  # 20 arrays would run at least 20 tasks
+        p.submit(skip_confirm=True)
+    assert not p.job_ids
+
+    p = Psub(name="throttled", shard_size=25, max_concurrent=10)
+    p.add([f"echo {i}" for i in range(1, 61)])
+    p.submit(skip_confirm=True)
+    assert len(p.job_ids) == 3
+    assert all("#$ -tc 3\n" in open(fn).read() for fn in fake_qsub.glob("submitted.*.sh"))
+
+    # the first shard has finished, the last finishes before its qalter
+    (fake_qsub / "qstat.xml").write_text("<job_info><job_info>" + "".join(
+        f"<job_list><JB_job_number>{job_id}</JB_job_number><state>r</state></job_list>"
+        for job_id in p.job_ids[1:]) + "</job_info></job_info>")
+    (fake_qsub / "qalter_gone").write_text(f"{p.job_ids[2]}\n")
+    p.set_max_concurrent(9)
+    assert (fake_qsub / "qalter_calls").read_text().splitlines() == [
+        f"-tc 4 {p.job_ids[1]}", f"-tc 4 {p.job_ids[2]}",
+    ]
+    (fake_qsub / "qalter_calls").unlink()
+
+    p = Psub(name="throttled", max_concurrent=10)
+    p.add([f"echo {i}" for i in range(1, 61)])
+    p.submit(skip_confirm=True)
+    job_id, = p.job_ids
+    assert "#$ -tc 10\n" in open(f"{fake_qsub}/submitted.{job_id}.sh").read()
+    (fake_qsub / "qstat.xml").write_text(
+        QSTAT_JOB_XML.format(job_id=job_id, job_name=f"{p.name}.commands.sh", state="r"))
+
+    def write_window(first_line, end_time, duration, exit_codes):
+        with open(f"{p.tmp_dir}/exit_status/ledger.n1", "ab") as f:
+            for i, exit_code in enumerate(exit_codes):
+                f.write(format_record(first_line + i, "S", end_time - duration, -1, "n1"))
+                f.write(format_record(first_line + i, "E", end_time, exit_code, "n1"))
+
+    controller = ConcurrencyController(p, min_limit=2, max_limit=12, window=100, min_samples=5)
+    write_window(1, 1000, 10, [0] * 10)
+    assert controller.step(now=1000) == (12, "recent commands ran well")
+    write_window(11, 1200, 30, [0] * 10)
+    assert controller.step(now=1200).limit == 6  # three times slower
+    write_window(21, 1400, 10, [0] * 3)
+    assert controller.step(now=1400).limit == 6  # too few to judge
+    write_window(24, 1410, 10, [1] * 5)
+    assert controller.step(now=1410).limit == 3
+    assert (fake_qsub / "qalter_calls").read_text().splitlines() == [
+        f"-tc 12 {job_id}", f"-tc 6 {job_id}", f"-tc 3 {job_id}",
+    ]
+    assert p.max_concurrent == 3
@@ -0,0 +1,262 @@
+import os
+import stat
+
+import pytest
+
+QSTAT_XML = """<?xml version='1.0'?>
+<job_info  xmlns:xsd="http://arc.liv.ac.uk/repos/darcs/sge/source/dist/util/resources/schemas/qstat/qstat.xsd">
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>1001</JB_job_number>
+      <JAT_prio>0.50500</JAT_prio>
+      <JB_name>QRLOGIN</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>r</state>
+      <JAT_start_time>2021-05-01T10:00:00</JAT_start_time>
+      <queue_name>pod_ib.q@n6001</queue_name>
+      <jclass_name></jclass_name>
+      <slots>1</slots>
+    </job_list>
+    <job_list state="running">
+      <JB_job_number>1002</JB_job_number>
+      <JAT_prio>0.50500</JAT_prio>
+      <JB_name>sweep.2021_05_01T0900.commands.sh_123</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>r</state>
+      <JAT_start_time>2021-05-01T09:30:00</JAT_start_time>
+      <queue_name>pod_ib.q@n6002</queue_name>
+      <jclass_name></jclass_name>
+      <slots>2</slots>
+      <tasks>1</tasks>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>1002</JB_job_number>
+      <JAT_prio>0.00000</JAT_prio>
+      <JB_name>sweep.2021_05_01T0900.commands.sh_123</JB_name>
+      <JB_owner>user</JB_owner>
+      <state>qw</state>
+      <JB_submission_time>2021-05-01T09:00:00</JB_submission_time>
+      <queue_name></queue_name>
+      <jclass_name></jclass_name>
+      <slots>2</slots>
+      <tasks>2-10:1</tasks>
+    </job_list>
+  </job_info>
+</job_info>
+"""
+
+
+@pytest.fixture()
+def fake_qstat(tmp_path, monkeypatch):
+    """qstat stand-in that prints QSTAT_XML and counts its invocations."""
+    import psub.utilities.qstat_snapshot as qstat_snapshot
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (tmp_path / "qstat.xml").write_text(QSTAT_XML)
+    qstat_fn = bin_dir / "qstat"
+    qstat_fn.write_text(
+        "#!/bin/bash\n"
+        f"echo called >> {tmp_path}/qstat_calls\n"
+        f"cat {tmp_path}/qstat.xml\n"
+    )
+    qstat_fn.chmod(qstat_fn.stat().st_mode | stat.S_IEXEC)
+
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setattr(qstat_snapshot, "SNAPSHOT_FN", f"{tmp_path}/cache/qstat_snapshot.xml")
+
+    def num_calls():
+        calls_fn = tmp_path / "qstat_calls"
+        return len(calls_fn.read_text().splitlines()) if calls_fn.exists() else 0
+
+    return num_calls
+
+
+def test_qstat_snapshot_is_shared_within_ttl(fake_qstat):
+    from psub.utilities.qstat_snapshot import get_qstat_xml
+    from psub.utilities.sge_monitor import get_job_list_direct
+
+    jobs = get_job_list_direct(ttl=60)
+    assert [j.JB_job_number for j in jobs] == [1001, 1002, 1002]
+    assert get_job_list_direct(ttl=60) is jobs
+    assert get_qstat_xml(ttl=60)[0].decode() == QSTAT_XML
+    assert fake_qstat() == 1
+
+    get_qstat_xml(ttl=0)
+    assert fake_qstat() == 2
+
+
+def test_stale_snapshot_is_not_used_when_qstat_fails(fake_qstat, tmp_path):
+    import subprocess
+    import time
+    import psub.utilities.qstat_snapshot as qstat_snapshot
+    from psub.utilities.qstat_snapshot import get_qstat_xml, StaleSnapshotError
+    from psub.utilities.sge_monitor import get_job_list_direct
+
+    taken_at = get_qstat_xml(ttl=60)[1]
+    (tmp_path / "qstat.xml").unlink()  # qstat fails from now on
+    assert get_qstat_xml(ttl=0)[1] == taken_at  # recent enough to stand in
+
+    # a job submitted after the snapshot can't be judged from it
+    with pytest.raises(StaleSnapshotError):
+        get_job_list_direct(ttl=0, not_before=taken_at + 1)
+    from psub import Psub
+    p = Psub(name="just_submitted")
+    p.job_ids, p.queued_time = [4242], taken_at + 1
+    assert p.scheduler_state() is None  # unknown, rather than gone
+
+    os.utime(qstat_snapshot.SNAPSHOT_FN, (time.time() - 3600, time.time() - 3600))
+    with pytest.raises(subprocess.CalledProcessError):
+        get_qstat_xml(ttl=0)
+
+
+def test_qstat_snapshot_threads_share_one_refresh(fake_qstat):
+    from concurrent.futures import ThreadPoolExecutor
+    from psub.utilities.qstat_snapshot import get_qstat_xml
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        snapshots = list(executor.map(lambda _: get_qstat_xml(ttl=60), range(8)))
+    assert {xml_.decode() for xml_, _ in snapshots} == {QSTAT_XML}
+    assert fake_qstat() == 1
+
+
+def test_iter_jobs_types_fields():
+    from datetime import datetime
+    from psub.utilities.sge_monitor import parse_job_list
+
+    interactive, running, pending = parse_job_list(QSTAT_XML.encode())
+    assert interactive.JB_name == "QRLOGIN" and interactive.tasks is None
+    assert running.JAT_start_time == datetime(2021, 5, 1, 9, 30)
+    assert running.slots == 2 and running.tasks == "1"
+    assert pending.queue_name is None and pending.tasks == "2-10:1"
+    assert pending.JB_submission_time == datetime(2021, 5, 1, 9)
+    assert "1002: qw" in pending.one_line_rep(color=False)
+
+
+def test_screen_renderer_only_rewrites_changed_lines():
+    import io
+    from psub.utilities.sge_monitor import ScreenRenderer
+
+    out = io.StringIO()
+    renderer = ScreenRenderer(out)
+    renderer.render(["a", "b", "c"])
+    out.truncate(0), out.seek(0)
+
+    renderer.render(["a", "B"])
+    assert out.getvalue() == "\033[2;1HB\033[K\033[3;1H\033[K"
+
+    out.truncate(0), out.seek(0)
+    renderer.render(["a", "B"])
+    assert out.getvalue() == ""
+
+
+def test_one_line_rep_only_elapsed_time_changes():
+    from datetime import datetime
+    from psub.utilities.sge_monitor import parse_job_list
+
+    job = parse_job_list(QSTAT_XML.encode())[1]
+    line_1 = job.one_line_rep(100, color=False, now=datetime(2021, 5, 1, 9, 31))
+    line_2 = job.one_line_rep(100, color=False, now=datetime(2021, 5, 1, 9, 45))
+    assert line_1.startswith("1002: r ➜ sweep.2021_05_01T0900.commands.sh_123")
+    assert line_1.replace("0:01:00", "0:15:00") == line_2
+    assert len(line_1) == 100
+
+
+def test_array_tasks_are_summarized_and_linked_to_history():
+    from datetime import datetime
+    from psub.utilities.sge_monitor import parse_job_list, summarize_jobs, count_tasks, Job
+
+    assert count_tasks(None) == 1
+    assert count_tasks("4-100:2,101") == 50
+
+    class Entry:
+        name = "sweep.2021_05_01T0900"
+        status = "Running [10%]"
+        job_ids = []
+
+        def load(self):
+            return self
+
+        def get_status(self, job_list=None):
+            return self.status
+
+    interactive, summary = summarize_jobs(parse_job_list(QSTAT_XML.encode()), [Entry()])
+    assert isinstance(interactive, Job)
+    assert (summary.running, summary.queued, summary.errors) == (1, 9, 0)
+    assert summary.hosts == {"n6002"}
+    line = summary.one_line_rep(120, color=False, now=datetime(2021, 5, 1, 10))
+    assert line.startswith("1002: array ➜ sweep.2021_05_01T0900.commands.sh_123")
+    assert line.endswith("| r1 qw9 E0 | 0:30:00 | n6002 | psub: Running [10%]")
+
+    class EntryWithJobId(Entry):
+        name = "renamed"
+        status = "Queued"
+        job_ids = [1002]
+
+    _, summary = summarize_jobs(parse_job_list(QSTAT_XML.encode()), [Entry(), EntryWithJobId()])
+    assert summary.psub_status == "Queued"
+
+
+def test_psub_statuses_are_worked_out_off_thread():
+    import threading
+    from psub.utilities.sge_monitor import PsubStatuses, parse_job_list, summarize_jobs
+
+    release = threading.Event()
+    job_lists = []
+
+    class Entry:
+        name = "sweep.2021_05_01T0900"
+        job_ids = [1002]
+
+        def load(self):
+            return self
+
+        def get_status(self, job_list=None):
+            job_lists.append(job_list)
+            release.wait(10)
+            return f"Running [{len(job_lists)}0%]"
+
+    job_list = parse_job_list(QSTAT_XML.encode())
+    psub_statuses = PsubStatuses(interval=60)
+    _, summary = summarize_jobs(job_list, [Entry()], psub_statuses)
+    assert summary.psub_status is None  # not waited for
+    _, summary = summarize_jobs(job_list, [Entry()], psub_statuses)
+    release.set()
+    psub_statuses.close()
+
+    _, summary = summarize_jobs(job_list, [Entry()], psub_statuses)
+    assert summary.psub_status == "Running [10%]"
+    assert job_lists == [job_list]  # once per interval, with the job list already read
+
+
+def test_interactive_nodes_are_probed_concurrently_once_each(tmp_path):
+    import time
+    from psub.utilities.cpu_probe import probe_interactive_nodes
+    from psub.utilities.sge_monitor import Job
+
+    ssh_fn = tmp_path / "ssh"
+    ssh_fn.write_text(
+        "#!/bin/bash\n"
+        "for arg; do case $arg in n*) node=$arg;; esac; done\n"
+        f"echo $node >> {tmp_path}/probed\n"
+        "[ $node = n3 ] && exec sleep 10\n"
+        "[ $node = n4 ] && { echo 'connection refused' >&2; exit 255; }\n"
+        "sleep 1; echo 12.5%\n"
+    )
+    ssh_fn.chmod(ssh_fn.stat().st_mode | stat.S_IEXEC)
+
+    job_list = [Job(JB_job_number=i, JB_name="QRLOGIN", queue_name=f"pod.q@{node}")
+                for i, node in enumerate(["n1", "n2", "n1", "n3", "n4"])]
+    job_list.append(Job(JB_job_number=9, JB_name="batch_job", queue_name="pod.q@n5"))
+
+    start = time.monotonic()
+    results = probe_interactive_nodes(job_list, timeout=3, ssh_cmd=str(ssh_fn))
+    assert time.monotonic() - start < 5
+
+    results_d = {r.node: r for r in results}
+    assert sorted((tmp_path / "probed").read_text().split()) == ["n1", "n2", "n3", "n4"]
+    assert results_d["n1"].cpu_usage == "12.5%" and len(results_d["n1"].jobs) == 2
+    assert results_d["n3"].error.startswith("timed out")
+    assert results_d["n4"].error == "connection refused"